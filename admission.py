@@ -0,0 +1,287 @@
+"""Contrôle d'admission des rendus.
+
+Deux protections, appliquées avant tout travail de rendu :
+
+- limitation de débit par client (clé d'API ou adresse IP) : seau à jetons
+  en billets par minute, tenu en mémoire (`memory`, propre au worker) ou
+  dans SQLite (`sqlite`, partagé entre les workers). Un client qui dépasse
+  son débit reçoit 429 avec `Retry-After`;
+- plafond de rendus simultanés par worker : un emplacement reste réservé
+  aux billets unitaires, qui passent aussi avant les lots en attente. Quand
+  l'attente moyenne dépasse ADMISSION_SHED_LATENCY, les nouveaux lots sont
+  refusés immédiatement (503 + `Retry-After`) plutôt que mis en file, et une
+  requête qui attend plus de ADMISSION_MAX_WAIT reçoit 503.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'sqlite').lower()
+RATE_LIMIT_DB = os.environ.get(
+    'RATE_LIMIT_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'ratelimit.sqlite3')
+)
+# Débit soutenu par client, en billets par minute (0 désactive la limitation)
+RATE_LIMIT_TICKETS_PER_MINUTE = float(os.environ.get('RATE_LIMIT_TICKETS_PER_MINUTE', 600))
+# Rafale maximale : capacité du seau, en billets
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', 300))
+
+# Requêtes de rendu admises simultanément par worker, dont au plus RENDER_BULK_SLOTS lots
+# (la mise en page WeasyPrint reste sérialisée par le verrou de render_engine)
+RENDER_SLOTS = int(os.environ.get('RENDER_SLOTS', 2))
+RENDER_BULK_SLOTS = int(os.environ.get('RENDER_BULK_SLOTS', max(1, RENDER_SLOTS - 1)))
+# Attente maximale d'un emplacement de rendu, en secondes
+ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', 5))
+# Au-delà de cette attente moyenne (secondes), les nouveaux lots sont refusés sans attendre
+ADMISSION_SHED_LATENCY = float(os.environ.get('ADMISSION_SHED_LATENCY', 2))
+
+
+class AdmissionRejected(Exception):
+    """Requête refusée : `status` (429 ou 503) et délai conseillé avant de réessayer"""
+
+    def __init__(self, status, retry_after, message):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.message = message
+
+
+def _refill(tokens, updated_at, now, rate, capacity):
+    return min(capacity, tokens + (now - updated_at) * rate)
+
+
+class MemoryBucketStore:
+    """Seaux à jetons en mémoire (un seul processus)"""
+
+    PRUNE_INTERVAL = 300
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.time()
+
+    def take(self, client, cost, rate, capacity):
+        """Retire `cost` jetons; retourne 0 si accordé, sinon le délai d'attente (s)"""
+        now = time.time()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(client, (capacity, now))
+            tokens = _refill(tokens, updated_at, now, rate, capacity)
+            if tokens < cost:
+                self._buckets[client] = (tokens, now)
+                return (cost - tokens) / rate
+            self._buckets[client] = (tokens - cost, now)
+            if now - self._last_prune > self.PRUNE_INTERVAL:
+                self._prune(now, rate, capacity)
+            return 0
+
+    def _prune(self, now, rate, capacity):
+        # Un seau inactif assez longtemps est plein : inutile de le garder
+        self._last_prune = now
+        idle = capacity / rate
+        for client in [c for c, (_, updated_at) in self._buckets.items() if now - updated_at > idle]:
+            del self._buckets[client]
+
+
+class SqliteBucketStore:
+    """Seaux à jetons SQLite partagés entre les workers"""
+
+    PRUNE_INTERVAL = 300
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._last_prune = time.time()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connect().execute("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                client TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    def _connect(self):
+        """Une connexion par thread (les connexions sqlite3 ne se partagent pas)"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def take(self, client, cost, rate, capacity):
+        """Retire `cost` jetons; retourne 0 si accordé, sinon le délai d'attente (s)"""
+        now = time.time()
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                "SELECT tokens, updated_at FROM buckets WHERE client = ?", (client,)
+            ).fetchone()
+            tokens = _refill(row[0], row[1], now, rate, capacity) if row else capacity
+            wait = 0 if tokens >= cost else (cost - tokens) / rate
+            if not wait:
+                tokens -= cost
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (client, tokens, updated_at) VALUES (?, ?, ?)",
+                (client, tokens, now)
+            )
+            if now - self._last_prune > self.PRUNE_INTERVAL:
+                self._last_prune = now
+                connection.execute(
+                    "DELETE FROM buckets WHERE updated_at < ?", (now - capacity / rate,)
+                )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+
+def create_bucket_store(name=RATE_LIMIT_STORE):
+    if name == 'memory':
+        return MemoryBucketStore()
+    if name == 'sqlite':
+        return SqliteBucketStore(RATE_LIMIT_DB)
+    raise ValueError(f"Stockage de limitation de débit inconnu: {name}")
+
+
+class RenderGate:
+    """Emplacements de rendu du worker, avec priorité aux billets unitaires"""
+
+    # Poids de la dernière attente dans la moyenne mobile
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self, slots=RENDER_SLOTS, bulk_slots=RENDER_BULK_SLOTS,
+                 max_wait=ADMISSION_MAX_WAIT, shed_latency=ADMISSION_SHED_LATENCY):
+        self.slots = slots
+        self.bulk_slots = min(bulk_slots, slots)
+        self.max_wait = max_wait
+        self.shed_latency = shed_latency
+        self.queue_latency = 0.0
+        self._active = 0
+        self._active_bulk = 0
+        self._waiting_single = 0
+        self._waiting_bulk = 0
+        self._condition = threading.Condition()
+
+    def _can_enter(self, bulk):
+        if self._active >= self.slots:
+            return False
+        if bulk:
+            return self._active_bulk < self.bulk_slots and self._waiting_single == 0
+        return True
+
+    def acquire(self, bulk, background=False):
+        """Attend un emplacement; lève AdmissionRejected (503) en cas de surcharge.
+
+        `background` (tâches asynchrones) : un lot attend son tour sans délai
+        maximal ni délestage, et son attente n'entre pas dans la moyenne.
+        """
+        start = time.monotonic()
+        with self._condition:
+            if background:
+                self._waiting_bulk += 1
+                try:
+                    while not self._can_enter(True):
+                        self._condition.wait()
+                finally:
+                    self._waiting_bulk -= 1
+                self._active += 1
+                self._active_bulk += 1
+                return
+            if bulk and self.queue_latency > self.shed_latency and not self._can_enter(bulk):
+                raise AdmissionRejected(503, self.queue_latency, "Service surchargé, réessayez plus tard")
+            deadline = start + self.max_wait
+            if bulk:
+                self._waiting_bulk += 1
+            else:
+                self._waiting_single += 1
+            try:
+                while not self._can_enter(bulk):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._record_wait(self.max_wait)
+                        raise AdmissionRejected(503, self.max_wait, "Service surchargé, réessayez plus tard")
+                    self._condition.wait(remaining)
+            finally:
+                if bulk:
+                    self._waiting_bulk -= 1
+                else:
+                    self._waiting_single -= 1
+            self._active += 1
+            if bulk:
+                self._active_bulk += 1
+            self._record_wait(time.monotonic() - start)
+
+    def release(self, bulk):
+        with self._condition:
+            self._active -= 1
+            if bulk:
+                self._active_bulk -= 1
+            self._condition.notify_all()
+
+    def _record_wait(self, wait):
+        self.queue_latency += self.LATENCY_SMOOTHING * (wait - self.queue_latency)
+
+    def describe(self):
+        with self._condition:
+            return {
+                'slots': self.slots,
+                'active': self._active,
+                'active_bulk': self._active_bulk,
+                'waiting_single': self._waiting_single,
+                'waiting_bulk': self._waiting_bulk,
+                'queue_latency_ms': round(self.queue_latency * 1000, 1),
+            }
+
+
+class RenderPermit:
+    """Emplacement de rendu accordé; libéré une seule fois, à la fin de la réponse"""
+
+    def __init__(self, gate, bulk):
+        self._gate = gate
+        self._bulk = bulk
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._gate.release(self._bulk)
+
+
+class AdmissionController:
+    def __init__(self, store, gate, rate_per_minute=RATE_LIMIT_TICKETS_PER_MINUTE,
+                 burst=RATE_LIMIT_BURST):
+        self.store = store
+        self.gate = gate
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+
+    def charge(self, client, cost):
+        """Retire `cost` jetons du seau du client; lève AdmissionRejected (429) s'il n'y en a pas assez"""
+        if self.rate <= 0 or cost <= 0:
+            return
+        wait = self.store.take(client, cost, self.rate, self.burst)
+        if wait:
+            raise AdmissionRejected(429, wait, "Trop de billets demandés, réessayez plus tard")
+
+    def admit(self, client, cost, bulk, render=True, prepaid=0):
+        """Applique le débit du client puis, si `render`, réserve un emplacement de rendu.
+
+        `prepaid` jetons ont déjà été retirés par `charge` (contrôle fait
+        avant la lecture du corps). Retourne un RenderPermit (ou None sans
+        rendu); lève AdmissionRejected.
+        """
+        # Un lot plus gros que la rafale vide le seau au lieu d'être refusé à jamais
+        self.charge(client, min(cost, self.burst) - prepaid)
+        if not render:
+            return None
+        self.gate.acquire(bulk)
+        return RenderPermit(self.gate, bulk)
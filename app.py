@@ -1,13 +1,40 @@
-from flask import Flask, request, send_file, render_template_string, jsonify
-from weasyprint import HTML, CSS
+from flask import Flask, Response, g, request, send_file, jsonify, url_for
+import base64
+import binascii
+import contextvars
 import io
 import logging
+from contextlib import nullcontext
 from datetime import datetime
+import hashlib
 import os
+import re
+import tempfile
+import time
+import unicodedata
+from urllib.parse import quote
 from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_cors import CORS
-import base64
-import requests
+from designs import DesignRegistry
+from pdf_stream import IncrementalPdfWriter, append_to_pdf, stream_merged_pdf
+from zip_stream import stream_zip
+import render_pool
+import raster
+from jobs import JobManager, create_broker
+import ingest
+from admission import AdmissionController, AdmissionRejected, RenderGate, create_bucket_store
+import coalesce
+from idempotency import IdempotencyConflict, IdempotencyStore, MAX_IDEMPOTENCY_KEY_LENGTH
+import result_cache
+from metrics import (
+    ADMISSION_REJECTED, BYTES_SENT, REQUEST_DURATION, TICKETS_GENERATED,
+    collect, counter_lines, registry, server_timing_header, stage
+)
+from images import process_image_url, prefetch_images, image_cache_stats
+from pdf_output import font_subset_stats
+from qrcodes import qr_code_data_uri
+from validation import ValidationError, merge_event_fields, validate_batch, validate_ticket
 
 # Configuration du logging
 logging.basicConfig(level=logging.INFO)
@@ -16,579 +43,32 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
+# Nombre de proxys devant le service (Render : 1) : X-Forwarded-For n'est lu que sur ces sauts
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=0)
+
 # Configuration
 app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024  # 32MB max
 
-# CSS amélioré pour le design de billet (180mm x 70mm) - Version corrigée
-TICKET_CSS = """
-@import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700;800&family=Playfair+Display:wght@400;600;700;800&display=swap');
-
-@page {
-    size: 180mm 70mm;
-    margin: 0;
-    padding: 0;
-}
-
-* {
-    box-sizing: border-box;
-}
-
-body {
-    margin: 0;
-    padding: 0;
-    font-family: 'Inter', sans-serif;
-    background: #ffffff;
-    width: 180mm;
-    height: 70mm;
-    overflow: hidden;
-}
-
-.ticket-container {
-    width: 180mm;
-    height: 70mm;
-    position: relative;
-    background: #ffffff;
-    overflow: hidden;
-}
-
-.ticket {
-    display: flex;
-    height: 100%;
-    width: 100%;
-    position: relative;
-    background: white;
-    overflow: hidden;
-}
-
-/* Ligne de découpe perforée */
-.ticket::before {
-    content: '';
-    position: absolute;
-    right: 45mm;
-    top: 0;
-    height: 100%;
-    width: 2px;
-    background: repeating-linear-gradient(
-        to bottom,
-        #ddd 0px,
-        #ddd 4px,
-        transparent 4px,
-        transparent 8px
-    );
-    z-index: 10;
-}
-
-/* Cercles de perforation */
-.ticket::after {
-    content: '';
-    position: absolute;
-    right: 44mm;
-    top: 50%;
-    transform: translateY(-50%);
-    width: 6px;
-    height: 6px;
-    border-radius: 50%;
-    background: #ddd;
-    box-shadow: 
-        0 -25mm 0 #ddd,
-        0 -20mm 0 #ddd,
-        0 -15mm 0 #ddd,
-        0 -10mm 0 #ddd,
-        0 -5mm 0 #ddd,
-        0 5mm 0 #ddd,
-        0 10mm 0 #ddd,
-        0 15mm 0 #ddd,
-        0 20mm 0 #ddd,
-        0 25mm 0 #ddd;
-    z-index: 11;
-}
-
-.ticket-main {
-    flex: 1;
-    display: flex;
-    position: relative;
-    background: white;
-    width: calc(180mm - 45mm);
-    height: 100%;
-}
-
-.ticket-left {
-    width: 50mm;
-    position: relative;
-    overflow: hidden;
-    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-}
-
-.event-image-container {
-    width: 100%;
-    height: 100%;
-    position: relative;
-    overflow: hidden;
-}
-
-.event-image {
-    width: 100%;
-    height: 100%;
-    object-fit: cover;
-    object-position: center;
-}
-
-.image-overlay {
-    position: absolute;
-    top: 0;
-    left: 0;
-    right: 0;
-    bottom: 0;
-    background: linear-gradient(
-        135deg, 
-        rgba(102, 126, 234, 0.1) 0%, 
-        rgba(118, 75, 162, 0.1) 100%
-    );
-}
-
-.price-badge {
-    position: absolute;
-    top: 8mm;
-    left: 0;
-    background: linear-gradient(135deg, #ffd700 0%, #ffed4e 100%);
-    color: #1a202c;
-    padding: 8px 16px 8px 12px;
-    font-size: 14px;
-    font-weight: 800;
-    border-radius: 0 25px 25px 0;
-    box-shadow: 0 4px 12px rgba(0,0,0,0.2);
-    z-index: 5;
-    clip-path: polygon(0 0, calc(100% - 8px) 0, 100% 50%, calc(100% - 8px) 100%, 0 100%);
-}
-
-.ticket-center {
-    flex: 1;
-    padding: 12mm 10mm;
-    display: flex;
-    flex-direction: column;
-    justify-content: space-between;
-    background: white;
-    position: relative;
-}
-
-.event-header {
-    margin-bottom: 8mm;
-}
-
-.event-title {
-    font-family: 'Playfair Display', serif;
-    font-size: 22px;
-    font-weight: 700;
-    color: #1a202c;
-    line-height: 1.2;
-    margin: 0 0 6px 0;
-    text-transform: uppercase;
-    letter-spacing: 0.5px;
-    /* Troncature pour titres longs */
-    display: -webkit-box;
-    -webkit-line-clamp: 2;
-    -webkit-box-orient: vertical;
-    overflow: hidden;
-    text-overflow: ellipsis;
-    max-height: 2.4em;
-}
-
-.event-subtitle {
-    font-size: 12px;
-    color: #64748b;
-    font-weight: 500;
-    text-transform: uppercase;
-    letter-spacing: 1px;
-}
-
-.ticket-details {
-    display: grid;
-    grid-template-columns: 1fr 1fr;
-    gap: 6mm;
-    margin-bottom: 6mm;
-}
-
-.detail-group {
-    display: flex;
-    flex-direction: column;
-    gap: 4px;
-}
-
-.detail-label {
-    font-size: 10px;
-    font-weight: 600;
-    color: #64748b;
-    text-transform: uppercase;
-    letter-spacing: 0.8px;
-    display: flex;
-    align-items: center;
-    gap: 6px;
-}
-
-.detail-value {
-    font-size: 13px;
-    font-weight: 600;
-    color: #1a202c;
-    line-height: 1.4;
-    /* Troncature pour valeurs longues */
-    overflow: hidden;
-    text-overflow: ellipsis;
-    display: -webkit-box;
-    -webkit-line-clamp: 2;
-    -webkit-box-orient: vertical;
-}
-
-.detail-icon {
-    width: 14px;
-    height: 14px;
-    display: inline-flex;
-    align-items: center;
-    justify-content: center;
-    background: linear-gradient(135deg, #667eea, #764ba2);
-    color: white;
-    border-radius: 4px;
-    font-size: 9px;
-    flex-shrink: 0;
-}
-
-.organizer-info {
-    padding: 6mm 0 0 0;
-    border-top: 1px solid #e2e8f0;
-    text-align: center;
-}
-
-.organizer-label {
-    font-size: 10px;
-    color: #64748b;
-    font-weight: 500;
-    margin-bottom: 4px;
-}
-
-.organizer-name {
-    font-size: 12px;
-    font-weight: 700;
-    color: #1a202c;
-    /* Troncature pour nom organisateur */
-    overflow: hidden;
-    text-overflow: ellipsis;
-    white-space: nowrap;
-}
-
-.ticket-stub {
-    width: 45mm;
-    background: linear-gradient(135deg, #1e293b 0%, #334155 100%);
-    display: flex;
-    flex-direction: column;
-    align-items: center;
-    justify-content: center;
-    position: relative;
-    padding: 10mm;
-}
-
-.ticket-type-badge {
-    position: absolute;
-    top: 0;
-    left: 50%;
-    transform: translateX(-50%);
-    background: linear-gradient(135deg, #ffd700 0%, #ffed4e 100%);
-    color: #1a202c;
-    padding: 6px 16px;
-    border-radius: 0 0 12px 12px;
-    font-size: 10px;
-    font-weight: 800;
-    text-transform: uppercase;
-    letter-spacing: 1px;
-    box-shadow: 0 2px 8px rgba(0,0,0,0.2);
-    white-space: nowrap;
-    overflow: hidden;
-    text-overflow: ellipsis;
-    max-width: 40mm;
-}
-
-.qr-section {
-    display: flex;
-    flex-direction: column;
-    align-items: center;
-    gap: 10px;
-    margin-top: 8mm;
-}
-
-.qr-label {
-    color: #94a3b8;
-    font-size: 10px;
-    font-weight: 600;
-    text-transform: uppercase;
-    letter-spacing: 1px;
-    text-align: center;
-    line-height: 1.3;
-}
-
-.qr-code-container {
-    width: 60px;
-    height: 60px;
-    background: white;
-    padding: 6px;
-    border-radius: 12px;
-    box-shadow: 0 4px 12px rgba(0,0,0,0.3);
-    display: flex;
-    align-items: center;
-    justify-content: center;
-}
-
-.qr-code-container img {
-    width: 100%;
-    height: 100%;
-    border-radius: 6px;
-}
-
-.ticket-reference {
-    color: #64748b;
-    font-size: 9px;
-    font-family: 'Courier New', monospace;
-    text-align: center;
-    font-weight: 500;
-    line-height: 1.3;
-    margin-top: 6px;
-}
-
-.ticket-reference-label {
-    font-size: 8px;
-    color: #475569;
-    margin-bottom: 3px;
-    font-weight: 600;
-}
-
-/* Responsive adjustments pour les petits billets */
-@media print {
-    .ticket-container {
-        animation: none;
-    }
-    
-    body {
-        -webkit-print-color-adjust: exact;
-        print-color-adjust: exact;
-    }
-}
-
-/* Amélioration de la lisibilité sur fond sombre */
-.ticket-stub * {
-    text-shadow: 0 1px 2px rgba(0,0,0,0.3);
-}
-
-/* Gestion des très longs textes */
-.long-text {
-    word-break: break-word;
-    hyphens: auto;
-}
-"""
-
-# Template HTML amélioré avec meilleure structure
-TICKET_HTML_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="fr">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Billet - {{ ticket.event_title }}</title>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
-</head>
-<body>
-    <div class="ticket-container">
-        <div class="ticket">
-            <div class="ticket-main">
-                <div class="ticket-left">
-                    {% if ticket.ticket_price %}
-                    <div class="price-badge">
-                        {{ ticket.ticket_price }}
-                    </div>
-                    {% endif %}
-                    <div class="event-image-container">
-                        <img class="event-image" src="{{ ticket.event_image_url }}" alt="{{ ticket.event_title }}">
-                        <div class="image-overlay"></div>
-                    </div>
-                </div>
-
-                <div class="ticket-center">
-                    <div class="event-header">
-                        <h1 class="event-title">{{ ticket.event_title }}</h1>
-                        <div class="event-subtitle">Billet d'entrée</div>
-                    </div>
-
-                    <div class="ticket-details">
-                        <div class="detail-group">
-                            <div class="detail-label">
-                                <span class="detail-icon">
-                                    <i class="fas fa-calendar"></i>
-                                </span>
-                                Date & Heure
-                            </div>
-                            <div class="detail-value">{{ ticket.event_date_time }}</div>
-                        </div>
-
-                        <div class="detail-group">
-                            <div class="detail-label">
-                                <span class="detail-icon">
-                                    <i class="fas fa-map-marker-alt"></i>
-                                </span>
-                                Lieu
-                            </div>
-                            <div class="detail-value long-text">
-                                {{ ticket.event_location }}
-                                {% if ticket.event_address %}
-                                <br><span style="font-size: 11px; color: #64748b;">{{ ticket.event_address }}</span>
-                                {% endif %}
-                            </div>
-                        </div>
-                    </div>
-
-                    <div class="organizer-info">
-                        <div class="organizer-label">Organisé par</div>
-                        <div class="organizer-name">{{ ticket.organizer_name }}</div>
-                    </div>
-                </div>
-            </div>
-
-            <div class="ticket-stub">
-                <div class="ticket-type-badge">
-                    {{ ticket.ticket_type }}
-                </div>
-
-                <div class="qr-section">
-                    <div class="qr-label">
-                        Scanner pour<br>validation
-                    </div>
-
-                    <div class="qr-code-container">
-                        <img src="{{ ticket.qr_code }}" alt="QR Code de validation">
-                    </div>
-
-                    <div class="ticket-reference">
-                        <div class="ticket-reference-label">RÉFÉRENCE</div>
-                        {{ ticket.reference }}
-                        {% if ticket.current_ticket and ticket.total_tickets %}
-                        <br>{{ ticket.current_ticket }}/{{ ticket.total_tickets }}
-                        {% endif %}
-                    </div>
-                </div>
-            </div>
-        </div>
-    </div>
-</body>
-</html>
-"""
-
-# Template pour tickets multiples avec page break
-MULTIPLE_TICKETS_HTML_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="fr">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Billets - {{ tickets[0].event_title }}</title>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
-    <style>
-        .page-break {
-            page-break-before: always;
-        }
-    </style>
-</head>
-<body>
-    {% for ticket in tickets %}
-    <div class="ticket-container{% if not loop.first %} page-break{% endif %}">
-        <div class="ticket">
-            <div class="ticket-main">
-                <div class="ticket-left">
-                    {% if ticket.ticket_price %}
-                    <div class="price-badge">
-                        {{ ticket.ticket_price }}
-                    </div>
-                    {% endif %}
-                    <div class="event-image-container">
-                        <img class="event-image" src="{{ ticket.event_image_url }}" alt="{{ ticket.event_title }}">
-                        <div class="image-overlay"></div>
-                    </div>
-                </div>
-
-                <div class="ticket-center">
-                    <div class="event-header">
-                        <h1 class="event-title">{{ ticket.event_title }}</h1>
-                        <div class="event-subtitle">Billet d'entrée</div>
-                    </div>
-
-                    <div class="ticket-details">
-                        <div class="detail-group">
-                            <div class="detail-label">
-                                <span class="detail-icon">
-                                    <i class="fas fa-calendar"></i>
-                                </span>
-                                Date & Heure
-                            </div>
-                            <div class="detail-value">{{ ticket.event_date_time }}</div>
-                        </div>
-
-                        <div class="detail-group">
-                            <div class="detail-label">
-                                <span class="detail-icon">
-                                    <i class="fas fa-map-marker-alt"></i>
-                                </span>
-                                Lieu
-                            </div>
-                            <div class="detail-value long-text">
-                                {{ ticket.event_location }}
-                                {% if ticket.event_address %}
-                                <br><span style="font-size: 11px; color: #64748b;">{{ ticket.event_address }}</span>
-                                {% endif %}
-                            </div>
-                        </div>
-                    </div>
-
-                    <div class="organizer-info">
-                        <div class="organizer-label">Organisé par</div>
-                        <div class="organizer-name">{{ ticket.organizer_name }}</div>
-                    </div>
-                </div>
-            </div>
-
-            <div class="ticket-stub">
-                <div class="ticket-type-badge">
-                    {{ ticket.ticket_type }}
-                </div>
-
-                <div class="qr-section">
-                    <div class="qr-label">
-                        Scanner pour<br>validation
-                    </div>
-
-                    <div class="qr-code-container">
-                        <img src="{{ ticket.qr_code }}" alt="QR Code de validation">
-                    </div>
-
-                    <div class="ticket-reference">
-                        <div class="ticket-reference-label">RÉFÉRENCE</div>
-                        {{ ticket.reference }}
-                        {% if ticket.current_ticket and ticket.total_tickets %}
-                        <br>{{ ticket.current_ticket }}/{{ ticket.total_tickets }}
-                        {% endif %}
-                    </div>
-                </div>
-            </div>
-        </div>
-    </div>
-    {% endfor %}
-</body>
-</html>
-"""
+# Au-delà de MAX_BUFFERED_TICKETS (ou si `stream` est demandé), les billets
+# sont rendus par lots de STREAM_CHUNK_SIZE et le PDF est envoyé en flux
+MAX_BUFFERED_TICKETS = 50
+MAX_BATCH_TICKETS = int(os.environ.get('MAX_BATCH_TICKETS', 10000))
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 25))
+# PDF rendu gardé en mémoire jusqu'à ce seuil, puis déversé dans un fichier temporaire
+PDF_SPOOL_THRESHOLD = int(os.environ.get('PDF_SPOOL_THRESHOLD', 2 * 1024 * 1024))
 
 def validate_ticket_data(data):
     """Valide les données du billet"""
-    required_fields = [
-        'event_title', 'event_date_time', 'event_location',
-        'ticket_type', 'qr_code', 'reference'
-    ]
-    
-    for field in required_fields:
-        if field not in data or not data[field]:
-            raise ValueError(f"Champ requis manquant: {field}")
+    validate_ticket(data)
+    return complete_ticket_data(data)
+
+def complete_ticket_data(data):
+    """Génère le QR code et complète les champs optionnels d'un billet déjà validé"""
+    # QR code : généré localement à partir de qr_payload, sinon qr_code fourni
+    if data.get('qr_payload'):
+        data['qr_code'] = qr_code_data_uri(str(data['qr_payload']))
     
     # Champs optionnels avec valeurs par défaut
     if 'event_image_url' not in data or not data['event_image_url']:
@@ -606,106 +86,386 @@ def validate_ticket_data(data):
         
     return data
 
-def process_image_url(image_url):
-    """Traite l'URL de l'image pour s'assurer qu'elle est accessible"""
-    if not image_url:
-        return None
-        
+def validate_tickets_batch(tickets, numbered_after=0):
+    """Valide tous les billets d'un lot (toutes les erreurs en une fois) et ajoute la numérotation automatique.
+
+    La numérotation continue après `numbered_after` billets déjà émis (ajout à un lot existant).
+    """
+    validate_batch(tickets)
+    validated_tickets = []
+    for i, ticket in enumerate(tickets):
+        validated_ticket = complete_ticket_data(ticket)
+        # Ajouter numérotation automatique si pas présente
+        if 'current_ticket' not in validated_ticket:
+            validated_ticket['current_ticket'] = numbered_after + i + 1
+        if 'total_tickets' not in validated_ticket:
+            validated_ticket['total_tickets'] = numbered_after + len(tickets)
+        validated_tickets.append(validated_ticket)
+    return validated_tickets
+
+def validation_error_response(e):
+    """Réponse 400 détaillant toutes les erreurs de validation"""
+    logger.error(f"Erreur de validation: {e}")
+    payload = {'error': str(e)}
+    if isinstance(e, ValidationError):
+        payload['errors'] = e.errors
+    return jsonify(payload), 400
+
+def apply_event_images(tickets):
+    """Télécharge en parallèle les images distinctes du lot et les injecte dans les billets"""
+    with stage('images'):
+        processed_images = prefetch_images(
+            ticket['event_image_url'] for ticket in tickets
+        )
+    for ticket in tickets:
+        processed_image = processed_images.get(ticket['event_image_url'])
+        if processed_image:
+            ticket['event_image_url'] = processed_image
+
+# Designs de billets (templates/<design>/) : templates compilés et feuilles de style
+# préchargées au démarrage du worker, rechargés quand la version d'un manifeste change
+designs = DesignRegistry()
+designs.load()
+
+def request_renderer(data):
+    """Moteur de rendu du design demandé (`?design=` ou champ `design` du corps)"""
+    return designs.get(request.args.get('design', data.get('design')))
+
+# Préchauffage du worker : état exposé par /health (propre à chaque processus)
+worker_state = {
+    'pid': None, 'warm_up_ms': None, 'boot_ms': None, 'ready_at': None, 'degraded': False, 'warm_up_error': None
+}
+
+def warm_up_worker(boot_started=None):
+    """Rend un billet d'exemple avant d'accepter du trafic (polices, caches de mise en page).
+
+    `boot_started` : instant (time.perf_counter) du début du démarrage du worker,
+    pour mesurer son temps de démarrage complet. Un échec du rendu d'exemple
+    n'empêche pas le worker de servir : il est déclaré prêt en mode dégradé
+    (`degraded` et `warm_up_error` dans /health et /health/ready).
+    """
+    start = time.perf_counter()
+    sample = complete_ticket_data({
+        'event_title': 'PRÉCHAUFFAGE',
+        'event_date_time': 'Samedi 20h',
+        'event_location': 'Salle',
+        'ticket_type': 'Standard',
+        'reference': '#WARMUP',
+        'qr_payload': 'WARMUP',
+    })
+    warm_up_error = None
     try:
-        # Si c'est déjà une URL data, la retourner
-        if image_url.startswith('data:'):
-            return image_url
-            
-        # Si c'est une URL HTTP/HTTPS, essayer de la télécharger
-        if image_url.startswith(('http://', 'https://')):
-            try:
-                response = requests.get(image_url, timeout=10, headers={
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                })
-                response.raise_for_status()
-                
-                content_type = response.headers.get('content-type', '')
-                if 'image' not in content_type:
-                    logger.warning(f"URL ne semble pas être une image: {content_type}")
-                    return None
-                
-                image_base64 = base64.b64encode(response.content).decode('utf-8')
-                return f"data:{content_type};base64,{image_base64}"
-                
-            except Exception as e:
-                logger.warning(f"Impossible de télécharger l'image: {e}")
-                return None
-        
-        return None
-        
+        designs.get().render_ticket_pdf(sample)
     except Exception as e:
-        logger.warning(f"Erreur traitement image URL: {e}")
-        return None
+        logger.error(f"Préchauffage du worker {os.getpid()} en échec: {str(e)}", exc_info=True)
+        warm_up_error = str(e)
+    now = time.perf_counter()
+    worker_state.update(
+        pid=os.getpid(),
+        warm_up_ms=round((now - start) * 1000, 1),
+        boot_ms=round((now - boot_started) * 1000, 1) if boot_started is not None else None,
+        ready_at=datetime.now().isoformat(),
+        degraded=warm_up_error is not None,
+        warm_up_error=warm_up_error
+    )
+    if warm_up_error is None:
+        logger.info(f"Worker {os.getpid()} préchauffé en {worker_state['warm_up_ms']:.0f} ms")
+
+def worker_ready():
+    return worker_state['pid'] == os.getpid()
+
+def cache_metrics():
+    """Compteurs des caches et des téléchargements d'images, lus au moment de l'export"""
+    image_stats = image_cache_stats()
+    lines = counter_lines(
+        'pdf_service_image_cache_total',
+        'Accès au cache d\'images par résultat',
+        {name: image_stats[name] for name in ('memory_hits', 'disk_hits', 'revalidated', 'misses')},
+        'result'
+    )
+    lines += counter_lines(
+        'pdf_service_image_fetch_failures_total',
+        'Échecs de téléchargement d\'images',
+        {'fetch': image_stats['errors']},
+        'kind'
+    )
+    lines += counter_lines(
+        'pdf_service_result_cache_total',
+        'Accès au cache de PDF par résultat',
+        result_cache.result_cache_stats(),
+        'result'
+    )
+    font_stats = font_subset_stats()
+    lines += counter_lines(
+        'pdf_service_font_subset_cache_total',
+        'Accès au cache des sous-ensembles de polices par résultat',
+        {name: font_stats[name] for name in ('hits', 'misses')},
+        'result'
+    )
+    return lines
+
+registry.register_collector(cache_metrics)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Durée et volume des réponses; en-tête Server-Timing sur demande (X-Timing: 1)"""
+    endpoint = request.endpoint or 'unknown'
+    if 'request_start' in g:
+        REQUEST_DURATION.observe(
+            time.perf_counter() - g.request_start,
+            endpoint=endpoint, status=response.status_code
+        )
+    
+    if response.content_length:
+        BYTES_SENT.inc(response.content_length, endpoint=endpoint)
+    elif response.is_streamed:
+        response.response = count_streamed_bytes(response.response, endpoint)
+    
+    if request.headers.get('X-Timing') == '1' and g.get('stage_timings'):
+        response.headers['Server-Timing'] = server_timing_header(g.stage_timings)
+    return response
+
+def count_streamed_bytes(body, endpoint):
+    for block in body:
+        BYTES_SENT.inc(len(block), endpoint=endpoint)
+        yield block
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Métriques au format d'exposition Prometheus (tous les workers si METRICS_DIR est défini)"""
+    return collect(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Endpoint de santé du service"""
     return jsonify({
-        'status': 'healthy',
+        'status': 'degraded' if worker_ready() and worker_state['degraded'] else 'healthy',
         'service': 'PDF Ticket Generator Pro',
         'timestamp': datetime.now().isoformat(),
         'version': '5.1.0',
-        'ticket_size': '180mm x 70mm'
+        'ticket_size': '180mm x 70mm',
+        'image_cache': image_cache_stats(),
+        'result_cache': result_cache.result_cache_stats(),
+        'font_subsets': font_subset_stats(),
+        'designs': designs.describe(),
+        'ready': worker_ready(),
+        'admission': admission.gate.describe(),
+        'worker': worker_state
     })
 
+@app.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """Sonde de disponibilité : 200 une fois le worker préchauffé (même en échec), 503 avant"""
+    if not worker_ready():
+        return jsonify({'ready': False}), 503
+    return jsonify({'ready': True, 'degraded': worker_state['degraded'], 'worker': worker_state})
+
+def cached_file_response(cache_key, download_name, mimetype='application/pdf'):
+    """Réponse 304 ou fichier (PDF, image) servi depuis le cache de résultats, sinon None"""
+    if cache_key in request.if_none_match:
+        result_cache.count('not_modified')
+        response = Response(status=304)
+        response.set_etag(cache_key)
+        return response
+    
+    with stage('cache_lookup'):
+        cached_file = result_cache.open_cached(cache_key)
+    if cached_file is None:
+        result_cache.count('misses')
+        return None
+    
+    result_cache.count('hits')
+    return send_cached_file(cached_file, download_name, cache_key, mimetype)
+
+def coalesced_response(cache_key, download_name, mimetype='application/pdf'):
+    """Résultat rendu par une requête identique pendant l'attente du verrou, sinon None"""
+    cached_file = result_cache.open_cached(cache_key)
+    if cached_file is None:
+        return None
+    result_cache.count('coalesced')
+    return send_cached_file(cached_file, download_name, cache_key, mimetype)
+
+def send_cached_file(result_file, download_name, etag, mimetype='application/pdf'):
+    """Envoie un résultat depuis un fichier ouvert, par blocs, sans le recopier en mémoire"""
+    size = result_file.seek(0, io.SEEK_END)
+    result_file.seek(0)
+    response = send_file(
+        result_file,
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=download_name,
+        etag=etag
+    )
+    # send_file ne connaît la taille que des BytesIO
+    response.content_length = size
+    return response
+
 @app.route('/generate-ticket', methods=['POST'])
 def generate_single_ticket():
     """Génère un billet unique au format 180mm x 70mm"""
     try:
-        data = request.get_json()
+        data = request_payload()
         
         if not data or 'ticket' not in data:
             return jsonify({'error': 'Données de billet requises'}), 400
             
-        ticket_data = validate_ticket_data(data['ticket'])
-        
-        # Traitement de l'image
-        if 'event_image_url' in ticket_data and ticket_data['event_image_url']:
-            processed_image = process_image_url(ticket_data['event_image_url'])
-            if processed_image:
-                ticket_data['event_image_url'] = processed_image
+        with stage('validate'):
+            ticket_data = validate_ticket_data(data['ticket'])
+            renderer = request_renderer(data)
+            # Sortie image (PNG/WebP) : ?format=png&dpi=200 ou champs `format`/`dpi` du corps
+            raster_format, dpi = raster.parse_raster_options(
+                request.args.get('format', data.get('format')),
+                request.args.get('dpi', data.get('dpi'))
+            )
+        reference = ticket_data.get('reference', 'ticket')
+        pdf_key = result_cache.payload_key(ticket_data, renderer.version)
+        if raster_format:
+            download_name = f"billet-{reference}.{raster_format}"
+            cache_key = result_cache.payload_key(ticket_data, renderer.version, kind=f'{raster_format}@{dpi}')
+            mimetype = raster.mimetype(raster_format)
+        else:
+            download_name = f"billet-{reference}.pdf"
+            cache_key = pdf_key
+            mimetype = 'application/pdf'
         
-        # Rendu HTML
-        html_content = render_template_string(TICKET_HTML_TEMPLATE, ticket=ticket_data)
+        _, replayed = claim_idempotency_key(idempotency_scope(), cache_key)
         
-        # Génération PDF avec options optimisées
-        html_doc = HTML(string=html_content, base_url=request.url_root)
-        css_doc = CSS(string=TICKET_CSS)
+        # Billet déjà rendu : 304 ou résultat servi depuis le cache
+        cached_response = cached_file_response(cache_key, download_name, mimetype)
+        if cached_response is not None:
+            return mark_replayed(cached_response, replayed)
         
-        pdf_buffer = io.BytesIO()
-        html_doc.write_pdf(
-            pdf_buffer, 
-            stylesheets=[css_doc]
-        )
-        pdf_buffer.seek(0)
-        
-        logger.info(f"Billet généré avec succès: {ticket_data.get('reference', 'N/A')}")
+        # Un seul rendu pour les requêtes identiques simultanées
+        with coalesce.hold(cache_key):
+            coalesced = coalesced_response(cache_key, download_name, mimetype)
+            if coalesced is not None:
+                return mark_replayed(coalesced, replayed)
+            
+            # Une image se rastérise depuis le PDF du billet, lui-même peut-être déjà en cache
+            pdf_file = result_cache.open_cached(pdf_key) if raster_format else None
+            if pdf_file is None:
+                # Traitement de l'image
+                if 'event_image_url' in ticket_data and ticket_data['event_image_url']:
+                    with stage('images'):
+                        processed_image = process_image_url(ticket_data['event_image_url'])
+                    if processed_image:
+                        ticket_data['event_image_url'] = processed_image
+                
+                # Rendu HTML puis génération PDF
+                pdf_file = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_THRESHOLD)
+                renderer.render_ticket_pdf(ticket_data, pdf_file, base_url=request.url_root)
+                result_cache.store(pdf_key, pdf_file)
+            
+            logger.info(f"Billet généré avec succès: {reference}")
+            TICKETS_GENERATED.inc(1, endpoint=request.endpoint)
+            
+            if not raster_format:
+                return mark_replayed(send_cached_file(pdf_file, download_name, cache_key), replayed)
+            
+            with pdf_file, stage('rasterise'):
+                image = raster.rasterise_pdf(pdf_file, raster_format, dpi)
+            result_cache.store(cache_key, image)
+        return mark_replayed(send_cached_file(io.BytesIO(image), download_name, cache_key, mimetype), replayed)
         
-        return send_file(
-            pdf_buffer,
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name=f"billet-{ticket_data.get('reference', 'ticket')}.pdf"
-        )
+    except IdempotencyConflict as e:
+        return idempotency_conflict_response(e)
         
     except ValueError as e:
-        logger.error(f"Erreur de validation: {e}")
-        return jsonify({'error': str(e)}), 400
+        return validation_error_response(e)
         
     except Exception as e:
         logger.error(f"Erreur génération billet: {str(e)}", exc_info=True)
         return jsonify({'error': 'Erreur interne du serveur', 'details': str(e)}), 500
 
+def set_download_name(response, download_name):
+    """En-tête Content-Disposition construit comme par `send_file` (nom ASCII de repli et `filename*`)"""
+    try:
+        download_name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple, 'filename*': f"UTF-8''{quote(download_name, safe='!#$&+-.^_`|~')}"}
+    else:
+        names = {'filename': download_name}
+    response.headers.set('Content-Disposition', 'attachment', **names)
+    return response
+
+def stream_tickets_pdf(renderer, tickets, download_name):
+    """Réponse PDF en flux (transfert chunked) rendue lot par lot"""
+    endpoint = request.endpoint
+    chunks = render_pool.iter_chunk_pdfs(renderer, tickets, STREAM_CHUNK_SIZE, base_url=request.url_root)
+    body = stream_merged_pdf(chunks)
+    
+    # Le premier lot est rendu avant la réponse : une erreur précoce reste une réponse 500
+    first_block = next(body)
+    
+    # L'emplacement de rendu suit le générateur : il n'est libéré qu'une fois le flux terminé
+    permit = g.pop('render_permit', None)
+    
+    def generate():
+        try:
+            yield first_block
+            try:
+                yield from body
+            except Exception as e:
+                logger.error(f"Erreur pendant l'envoi en flux des billets: {str(e)}", exc_info=True)
+                raise
+            logger.info(f"Billets multiples générés en flux: {len(tickets)} billets")
+            TICKETS_GENERATED.inc(len(tickets), endpoint=endpoint)
+        finally:
+            if permit is not None:
+                permit.release()
+    
+    return set_download_name(Response(generate(), mimetype='application/pdf'), download_name)
+
+def ticket_file_names(tickets):
+    """Noms de fichiers des billets dans une archive (référence nettoyée, sans doublon)"""
+    names = []
+    seen = {}
+    for index, ticket in enumerate(tickets):
+        stem = re.sub(r'[^\w.-]+', '_', str(ticket.get('reference') or '')).strip('._') or str(index + 1)
+        seen[stem] = seen.get(stem, 0) + 1
+        if seen[stem] > 1:
+            stem = f'{stem}-{seen[stem]}'
+        names.append(f'billet-{stem}.pdf')
+    return names
+
+def stream_tickets_zip(renderer, tickets, download_name):
+    """Archive ZIP en flux : un PDF par billet, ajouté dès qu'il est rendu"""
+    endpoint = request.endpoint
+    pdfs = render_pool.iter_ticket_pdfs(renderer, tickets, base_url=request.url_root)
+    body = stream_zip(zip(ticket_file_names(tickets), pdfs))
+    
+    # Le premier billet est rendu avant la réponse : une erreur précoce reste une réponse 500
+    first_block = next(body)
+    
+    # L'emplacement de rendu suit le générateur : il n'est libéré qu'une fois le flux terminé
+    permit = g.pop('render_permit', None)
+    
+    def generate():
+        try:
+            yield first_block
+            try:
+                yield from body
+            except Exception as e:
+                logger.error(f"Erreur pendant l'envoi de l'archive des billets: {str(e)}", exc_info=True)
+                raise
+            logger.info(f"Archive de billets générée: {len(tickets)} billets")
+            TICKETS_GENERATED.inc(len(tickets), endpoint=endpoint)
+        finally:
+            if permit is not None:
+                permit.release()
+    
+    return set_download_name(Response(generate(), mimetype='application/zip'), download_name)
+
 @app.route('/generate-multiple-tickets', methods=['POST'])
 def generate_multiple_tickets():
     """Génère plusieurs billets en un seul PDF"""
     try:
-        data = request.get_json()
+        data = request_payload()
         
         if not data or 'tickets' not in data or not isinstance(data['tickets'], list):
             return jsonify({'error': 'Liste de billets requise'}), 400
@@ -713,82 +473,429 @@ def generate_multiple_tickets():
         if len(data['tickets']) == 0:
             return jsonify({'error': 'Au moins un billet requis'}), 400
             
-        if len(data['tickets']) > 50:
-            return jsonify({'error': 'Maximum 50 billets par requête'}), 400
+        if len(data['tickets']) > MAX_BATCH_TICKETS:
+            return jsonify({'error': f'Maximum {MAX_BATCH_TICKETS} billets par requête'}), 400
         
-        # Validation de tous les billets
-        validated_tickets = []
-        for i, ticket in enumerate(data['tickets']):
-            try:
-                validated_ticket = validate_ticket_data(ticket)
-                # Ajouter numérotation automatique si pas présente
-                if 'current_ticket' not in validated_ticket:
-                    validated_ticket['current_ticket'] = i + 1
-                if 'total_tickets' not in validated_ticket:
-                    validated_ticket['total_tickets'] = len(data['tickets'])
-                    
-                if 'event_image_url' in validated_ticket and validated_ticket['event_image_url']:
-                    processed_image = process_image_url(validated_ticket['event_image_url'])
-                    if processed_image:
-                        validated_ticket['event_image_url'] = processed_image
-                validated_tickets.append(validated_ticket)
-            except ValueError as e:
-                return jsonify({'error': f'Erreur billet {i+1}: {str(e)}'}), 400
-        
-        # Rendu HTML
-        html_content = render_template_string(MULTIPLE_TICKETS_HTML_TEMPLATE, tickets=validated_tickets)
-        
-        # Génération PDF
-        html_doc = HTML(string=html_content, base_url=request.url_root)
-        css_doc = CSS(string=TICKET_CSS)
-        
-        pdf_buffer = io.BytesIO()
-        html_doc.write_pdf(
-            pdf_buffer, 
-            stylesheets=[css_doc]
-        )
-        pdf_buffer.seek(0)
+        streaming = bool(data.get('stream')) or len(data['tickets']) > MAX_BUFFERED_TICKETS
+        # `pdf` : un seul PDF pour tout le lot; `zip` : un PDF par billet dans une archive
+        output = str(request.args.get('output', data.get('output', 'pdf'))).lower()
+        if output not in ('pdf', 'zip'):
+            return jsonify({'error': f'Sortie non supportée: {output} (pdf ou zip)'}), 400
+        
+        with stage('validate'):
+            validated_tickets = validate_tickets_batch(merge_event_fields(data))
+            renderer = request_renderer(data)
+        download_name = f"billets-{validated_tickets[0].get('reference', 'tickets')}.pdf"
+        
+        if output == 'zip':
+            apply_event_images(validated_tickets)
+            return stream_tickets_zip(renderer, validated_tickets, download_name[:-len('.pdf')] + '.zip')
+        
+        if streaming:
+            apply_event_images(validated_tickets)
+            return stream_tickets_pdf(renderer, validated_tickets, download_name)
+        
+        # Lot déjà rendu : 304 ou PDF servi depuis le cache
+        cache_key = result_cache.payload_key(validated_tickets, renderer.version)
+        _, replayed = claim_idempotency_key(idempotency_scope(), cache_key)
+        cached_response = cached_file_response(cache_key, download_name)
+        if cached_response is not None:
+            return mark_replayed(cached_response, replayed)
+        
+        # Un seul rendu pour les requêtes identiques simultanées
+        with coalesce.hold(cache_key):
+            coalesced = coalesced_response(cache_key, download_name)
+            if coalesced is not None:
+                return mark_replayed(coalesced, replayed)
+            
+            apply_event_images(validated_tickets)
+            
+            # Rendu HTML puis génération PDF
+            pdf_file = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_THRESHOLD)
+            renderer.render_tickets_pdf(validated_tickets, pdf_file, base_url=request.url_root)
+            result_cache.store(cache_key, pdf_file)
         
         logger.info(f"Billets multiples générés: {len(validated_tickets)} billets")
+        TICKETS_GENERATED.inc(len(validated_tickets), endpoint=request.endpoint)
         
-        return send_file(
-            pdf_buffer,
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name=f"billets-{validated_tickets[0].get('reference', 'tickets')}.pdf"
-        )
+        return mark_replayed(send_cached_file(pdf_file, download_name, cache_key), replayed)
+        
+    except IdempotencyConflict as e:
+        return idempotency_conflict_response(e)
+        
+    except ValueError as e:
+        return validation_error_response(e)
         
     except Exception as e:
         logger.error(f"Erreur génération billets multiples: {str(e)}", exc_info=True)
         return jsonify({'error': 'Erreur interne du serveur', 'details': str(e)}), 500
 
+def open_base_pdf(data):
+    """PDF à compléter : lot en cache (`batch_id`) ou PDF fourni en base64 (`pdf`).
+    
+    Retourne (fichier, empreinte); le fichier est None si le lot n'est plus en cache.
+    """
+    batch_id = data.get('batch_id')
+    pdf_data = data.get('pdf')
+    if (batch_id is None) == (pdf_data is None):
+        raise ValueError("Champ batch_id ou pdf requis (un seul des deux)")
+    if batch_id is not None:
+        if not isinstance(batch_id, str) or not re.fullmatch(r'[0-9a-f]{64}', batch_id):
+            raise ValueError("batch_id invalide (valeur de l'ETag d'un lot généré)")
+        return result_cache.open_cached(batch_id), batch_id
+    if not isinstance(pdf_data, str):
+        raise ValueError("Le champ pdf doit être encodé en base64")
+    try:
+        pdf_bytes = base64.b64decode(pdf_data, validate=True)
+    except binascii.Error:
+        raise ValueError("Le champ pdf doit être encodé en base64")
+    if not pdf_bytes.startswith(b'%PDF-'):
+        raise ValueError("Le champ pdf ne contient pas un PDF")
+    return io.BytesIO(pdf_bytes), hashlib.sha256(pdf_bytes).hexdigest()
+
+@app.route('/append-tickets', methods=['POST'])
+def append_tickets():
+    """Ajoute des billets à un PDF existant par mise à jour incrémentale, sans re-rendre ses pages"""
+    try:
+        data = request_payload()
+        
+        if not data or 'tickets' not in data or not isinstance(data['tickets'], list):
+            return jsonify({'error': 'Liste de billets requise'}), 400
+            
+        if len(data['tickets']) == 0:
+            return jsonify({'error': 'Au moins un billet requis'}), 400
+            
+        if len(data['tickets']) > MAX_BATCH_TICKETS:
+            return jsonify({'error': f'Maximum {MAX_BATCH_TICKETS} billets par requête'}), 400
+        
+        with stage('base'):
+            base_file, base_key = open_base_pdf(data)
+        if base_file is None:
+            return jsonify({'error': 'Lot introuvable ou expiré, renvoyez le PDF dans le champ pdf'}), 404
+        
+        with base_file:
+            with stage('validate'):
+                base_pdf = IncrementalPdfWriter(base_file)
+                # Sans numérotation fournie, les nouveaux billets suivent ceux du PDF d'origine (une page par billet)
+                validated_tickets = validate_tickets_batch(
+                    merge_event_fields(data), numbered_after=base_pdf.base_page_count
+                )
+                renderer = request_renderer(data)
+            
+            download_name = f"billets-{validated_tickets[0].get('reference', 'tickets')}.pdf"
+            # Le résultat est lui-même un lot en cache : son ETag sert de batch_id à l'ajout suivant
+            tickets_key = result_cache.payload_key(validated_tickets, renderer.version, kind='append')
+            cache_key = hashlib.sha256(f'{base_key}:{tickets_key}'.encode('utf-8')).hexdigest()
+            _, replayed = claim_idempotency_key(idempotency_scope(), cache_key)
+            
+            cached_response = cached_file_response(cache_key, download_name)
+            if cached_response is not None:
+                return mark_replayed(cached_response, replayed)
+            
+            with coalesce.hold(cache_key):
+                coalesced = coalesced_response(cache_key, download_name)
+                if coalesced is not None:
+                    return mark_replayed(coalesced, replayed)
+                
+                apply_event_images(validated_tickets)
+                
+                # Seules les nouvelles pages sont rendues; le PDF d'origine est recopié tel quel
+                chunks = render_pool.iter_chunk_pdfs(
+                    renderer, validated_tickets, STREAM_CHUNK_SIZE, base_url=request.url_root
+                )
+                pdf_file = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_THRESHOLD)
+                with stage('append'):
+                    append_to_pdf(base_file, chunks, pdf_file, writer=base_pdf)
+                result_cache.store(cache_key, pdf_file)
+        
+        logger.info(f"Billets ajoutés au lot: {len(validated_tickets)} billets")
+        TICKETS_GENERATED.inc(len(validated_tickets), endpoint=request.endpoint)
+        
+        return mark_replayed(send_cached_file(pdf_file, download_name, cache_key), replayed)
+        
+    except IdempotencyConflict as e:
+        return idempotency_conflict_response(e)
+        
+    except ValueError as e:
+        return validation_error_response(e)
+        
+    except Exception as e:
+        logger.error(f"Erreur ajout de billets: {str(e)}", exc_info=True)
+        return jsonify({'error': 'Erreur interne du serveur', 'details': str(e)}), 500
+
+def render_job(payload, result_path, report_progress):
+    """Rend le PDF d'une tâche asynchrone sur disque, lot par lot.
+
+    Le rendu occupe un emplacement de lot du worker, comme un lot reçu en
+    requête : les tâches ne s'ajoutent pas aux RENDER_SLOTS.
+    """
+    tickets = payload['tickets']
+    renderer = designs.get(payload.get('design'))
+    apply_event_images(tickets)
+    admission.gate.acquire(True, background=True)
+    try:
+        chunks = render_pool.iter_chunk_pdfs(
+            renderer, tickets, STREAM_CHUNK_SIZE, base_url=payload.get('base_url')
+        )
+        with open(result_path, 'wb') as result_file:
+            for index, block in enumerate(stream_merged_pdf(chunks)):
+                result_file.write(block)
+                report_progress(min((index + 1) * STREAM_CHUNK_SIZE, len(tickets)))
+    finally:
+        admission.gate.release(True)
+    TICKETS_GENERATED.inc(len(tickets), endpoint='jobs')
+
+job_manager = JobManager(create_broker(), render_job)
+
+@app.before_request
+def start_job_workers():
+    """Démarre les threads de traitement des tâches dans chaque worker"""
+    job_manager.ensure_started()
+
+# Contrôle d'admission : débit par client et emplacements de rendu du worker
+admission = AdmissionController(create_bucket_store(), RenderGate())
+
+# Route -> (lot, rendu dans la requête)
+ADMITTED_ENDPOINTS = {
+    'generate_single_ticket': (False, True),
+    'generate_multiple_tickets': (True, True),
+    'append_tickets': (True, True),
+    'preview_ticket': (False, False),
+    'create_job': (True, False),
+}
+
+# Clés d'API reconnues (séparées par des virgules), gardées sous forme d'empreintes
+API_KEY_DIGESTS = {
+    hashlib.sha256(key.strip().encode('utf-8')).hexdigest()
+    for key in os.environ.get('API_KEYS', '').split(',') if key.strip()
+}
+
+# Jetons déjà retirés par le point d'entrée ASGI (asgi.py), avant le préchargement des images
+prepaid_tokens = contextvars.ContextVar('prepaid_tokens', default=0)
+
+def client_key(api_key, remote_addr):
+    """Client à qui imputer le débit : clé d'API reconnue (empreinte) ou adresse IP"""
+    if api_key:
+        digest = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+        # Une clé inconnue ne doit pas ouvrir un nouveau seau : le débit reste celui de l'adresse
+        if digest in API_KEY_DIGESTS:
+            return 'key:' + digest[:16]
+    return 'ip:' + (remote_addr or 'unknown')
+
+def client_id():
+    return client_key(request.headers.get('X-API-Key'), request.remote_addr)
+
+def environ_client_id(environ):
+    """client_id() avant l'application Flask (asgi.py), avec les mêmes proxys de confiance"""
+    if TRUSTED_PROXY_HOPS > 0:
+        environ = dict(environ)
+        ProxyFix(lambda *args: None, x_for=TRUSTED_PROXY_HOPS, x_proto=0)(environ, None)
+    return client_key(environ.get('HTTP_X_API_KEY'), environ.get('REMOTE_ADDR'))
+
+# Idempotency-Key : une nouvelle tentative rejoue le résultat de la première requête
+idempotency = IdempotencyStore()
+
+def idempotency_scope():
+    """Idempotency-Key de la requête, propre au client, ou None"""
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        return None
+    if len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise ValueError(f"Idempotency-Key trop longue (maximum {MAX_IDEMPOTENCY_KEY_LENGTH} caractères)")
+    return f'{client_id()}:{key}'
+
+def claim_idempotency_key(scope, fingerprint):
+    """Réserve la clé pour cette requête : (résultat enregistré, nouvelle tentative ?)"""
+    if scope is None:
+        return None, False
+    return idempotency.claim(scope, fingerprint)
+
+def mark_replayed(response, replayed):
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def idempotency_conflict_response(e):
+    return jsonify({'error': str(e)}), 422
+
+def request_payload():
+    """Corps décodé de la requête de rendu (voir `load_request_payload`)"""
+    return g.get('payload')
+
+def admission_rejected_response(e):
+    ADMISSION_REJECTED.inc(endpoint=request.endpoint, status=e.status)
+    logger.warning(f"Requête refusée ({e.status}) pour {client_id()}: {e.message}")
+    response = jsonify({'error': e.message, 'code': e.status})
+    response.status_code = e.status
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+@app.before_request
+def load_request_payload():
+    """Décode le corps (JSON, NDJSON ou multipart, éventuellement gzip/zstd) avant l'admission.
+
+    Un premier jeton est retiré avant la lecture : un client déjà au-delà de
+    son débit est refusé sans que son corps (jusqu'à MAX_DECOMPRESSED_BYTES)
+    soit décompressé ni analysé. Le reste du coût est retiré par `admit_request`.
+    """
+    if request.endpoint not in ADMITTED_ENDPOINTS or request.method != 'POST':
+        return None
+    try:
+        if not prepaid_tokens.get():
+            admission.charge(client_id(), 1)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    try:
+        with stage('parse'):
+            g.payload = ingest.read_payload(request, MAX_BATCH_TICKETS)
+    except ValueError as e:
+        return validation_error_response(e)
+    return None
+
+@app.before_request
+def admit_request():
+    """Refuse vite (429/503 + Retry-After) plutôt que de laisser la file s'allonger"""
+    admitted = ADMITTED_ENDPOINTS.get(request.endpoint)
+    if admitted is None or request.method != 'POST':
+        return None
+    bulk, render = admitted
+    data = request_payload()
+    tickets = data.get('tickets') if isinstance(data, dict) else None
+    cost = len(tickets) if bulk and isinstance(tickets, list) and tickets else 1
+    try:
+        with stage('queue'):
+            # Le premier jeton (ou tout le coût, en ASGI) a été retiré avant la lecture du corps
+            prepaid = prepaid_tokens.get() or 1
+            g.render_permit = admission.admit(client_id(), cost, bulk and cost > 1, render, prepaid=prepaid)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    return None
+
+@app.after_request
+def release_render_permit(response):
+    """Libère l'emplacement de rendu dès que la réponse est prête.
+
+    Les réponses en flux, qui rendent en envoyant, le reprennent dans `g` et
+    le libèrent à la fin de leur générateur (voir `stream_tickets_pdf`) :
+    `close()` n'est pas appelé par tous les serveurs (asgiref ne le fait pas).
+    """
+    permit = g.pop('render_permit', None)
+    if permit is not None:
+        permit.release()
+    return response
+
+def job_status(job):
+    status = dict(job)
+    status['status_url'] = url_for('get_job', job_id=job['id'])
+    if job['status'] == 'done':
+        status['download_url'] = url_for('download_job', job_id=job['id'])
+    return status
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """Met en file la génération d'un lot de billets et retourne l'identifiant de la tâche"""
+    try:
+        data = request_payload()
+        
+        if not data or 'tickets' not in data or not isinstance(data['tickets'], list):
+            return jsonify({'error': 'Liste de billets requise'}), 400
+            
+        if len(data['tickets']) == 0:
+            return jsonify({'error': 'Au moins un billet requis'}), 400
+            
+        if len(data['tickets']) > MAX_BATCH_TICKETS:
+            return jsonify({'error': f'Maximum {MAX_BATCH_TICKETS} billets par requête'}), 400
+        
+        with stage('validate'):
+            validated_tickets = validate_tickets_batch(merge_event_fields(data))
+            renderer = request_renderer(data)
+        
+        scope = idempotency_scope()
+        # Verrou sur la clé : deux tentatives simultanées ne créent qu'une tâche
+        with coalesce.hold(f'job:{scope}') if scope else nullcontext():
+            fingerprint = result_cache.payload_key(validated_tickets, renderer.version, kind='job')
+            job_id, replayed = claim_idempotency_key(scope, fingerprint)
+            job = job_manager.get(job_id) if job_id else None
+            if job is None:
+                # Pas encore de tâche pour cette clé (ou tâche expirée) : nouvelle tâche
+                replayed = False
+                job_id = job_manager.submit(
+                    {'tickets': validated_tickets, 'base_url': request.url_root, 'design': renderer.design},
+                    total=len(validated_tickets)
+                )
+                if scope:
+                    idempotency.set_result(scope, job_id)
+                job = job_manager.get(job_id)
+                logger.info(f"Tâche {job_id} créée: {len(validated_tickets)} billets")
+        
+        response = mark_replayed(jsonify(job_status(job)), replayed)
+        response.status_code = 202
+        response.headers['Location'] = url_for('get_job', job_id=job_id)
+        return response
+        
+    except IdempotencyConflict as e:
+        return idempotency_conflict_response(e)
+        
+    except ValueError as e:
+        return validation_error_response(e)
+        
+    except Exception as e:
+        logger.error(f"Erreur création tâche: {str(e)}", exc_info=True)
+        return jsonify({'error': 'Erreur interne du serveur', 'details': str(e)}), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """État et progression d'une tâche"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Tâche introuvable'}), 404
+    return jsonify(job_status(job))
+
+@app.route('/jobs/<job_id>/download', methods=['GET'])
+def download_job(job_id):
+    """Télécharge le PDF d'une tâche terminée"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Tâche introuvable'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': 'Tâche non terminée', 'status': job['status']}), 409
+    return send_file(
+        job_manager.result_path(job_id),
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=f"billets-{job_id}.pdf"
+    )
+
 @app.route('/preview-ticket', methods=['POST'])
 def preview_ticket():
     """Génère un aperçu HTML du billet (pour tests)"""
     try:
-        data = request.get_json()
+        data = request_payload()
         
         if not data or 'ticket' not in data:
             return jsonify({'error': 'Données de billet requises'}), 400
             
-        ticket_data = validate_ticket_data(data['ticket'])
+        with stage('validate'):
+            ticket_data = validate_ticket_data(data['ticket'])
+            renderer = request_renderer(data)
         
         # Traitement de l'image
         if 'event_image_url' in ticket_data and ticket_data['event_image_url']:
-            processed_image = process_image_url(ticket_data['event_image_url'])
+            with stage('images'):
+                processed_image = process_image_url(ticket_data['event_image_url'])
             if processed_image:
                 ticket_data['event_image_url'] = processed_image
         
         # Rendu HTML avec CSS intégré
         html_content = f"""
-        <style>{TICKET_CSS}</style>
-        {render_template_string(TICKET_HTML_TEMPLATE, ticket=ticket_data)}
+        <style>{renderer.css}</style>
+        {renderer.render_single_html(ticket_data, icons_href=renderer.icons_url)}
         """
         
         return html_content, 200, {'Content-Type': 'text/html; charset=utf-8'}
         
     except ValueError as e:
-        return jsonify({'error': str(e)}), 400
+        return validation_error_response(e)
         
     except Exception as e:
         logger.error(f"Erreur aperçu billet: {str(e)}", exc_info=True)
@@ -812,6 +919,7 @@ def handle_exception(e):
     }), 500
 
 if __name__ == '__main__':
+    warm_up_worker()
     app.run(
         host='0.0.0.0',
         port=int(os.environ.get('PORT', 5000)),
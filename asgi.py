@@ -0,0 +1,187 @@
+"""Point d'entrée ASGI : service asynchrone avec téléchargement d'images non bloquant.
+
+    uvicorn asgi:application --workers 4
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+
+Pour les routes de rendu, le corps JSON est analysé et validé dans un
+thread, puis le débit du client est débité : un client au-delà de son débit
+reçoit 429 sans qu'aucune image ne soit téléchargée. Les images distantes
+sont ensuite téléchargées avec un client httpx asynchrone à pool de
+connexions (le cache d'images est ainsi rempli sans bloquer la boucle
+d'événements). La requête est enfin confiée à l'application Flask dans un
+thread dédié : le rendu WeasyPrint, limité par le CPU, ne s'exécute jamais
+sur la boucle. Un hôte d'images lent n'immobilise donc plus de worker.
+"""
+import asyncio
+import json
+import os
+
+import httpx
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+from admission import AdmissionRejected
+from app import ADMITTED_ENDPOINTS, admission, app, environ_client_id, prepaid_tokens, warm_up_worker
+from images import IMAGE_FETCH_WORKERS, HTTP_HEADERS, prefetch_images_async
+from metrics import ADMISSION_REJECTED
+from validation import merge_event_fields, validate_batch, validate_ticket
+
+# Chemin -> route Flask
+RENDER_ROUTES = {
+    '/generate-ticket': 'generate_single_ticket',
+    '/generate-multiple-tickets': 'generate_multiple_tickets',
+    '/append-tickets': 'append_tickets',
+    '/preview-ticket': 'preview_ticket',
+}
+
+# Rendus WeasyPrint simultanés par processus (WeasyPrint n'est pas conçu pour le multi-thread)
+ASGI_RENDER_CONCURRENCY = int(os.environ.get('ASGI_RENDER_CONCURRENCY', 1))
+
+flask_application = WsgiToAsgi(app)
+
+_client = None
+_render_slots = None
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            headers=HTTP_HEADERS,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=IMAGE_FETCH_WORKERS * 4)
+        )
+    return _client
+
+
+def _get_render_slots():
+    global _render_slots
+    if _render_slots is None:
+        _render_slots = asyncio.Semaphore(ASGI_RENDER_CONCURRENCY)
+    return _render_slots
+
+
+def _image_urls(body, bulk):
+    """(URLs d'images, coût en jetons) d'un corps JSON de billet(s) valide; ([], 0) si le corps est invalide
+
+    Un lot invalide est refusé par Flask sans qu'aucune image ne soit téléchargée.
+    Analyse et validation s'exécutent hors de la boucle d'événements.
+    """
+    try:
+        data = json.loads(body)
+        if not isinstance(data, dict):
+            return [], 0
+        if isinstance(data.get('tickets'), list):
+            tickets = merge_event_fields(data)
+            validate_batch(tickets)
+        else:
+            tickets = [data.get('ticket')]
+            validate_ticket(tickets[0])
+    except ValueError:
+        return [], 0
+    # Même coût que `admit_request` : un jeton par billet pour un lot, dans la limite de la rafale
+    cost = min(len(tickets), admission.burst) if bulk and tickets else 1
+    urls = [
+        ticket['event_image_url'] for ticket in tickets
+        if isinstance(ticket.get('event_image_url'), str)
+    ]
+    return urls, cost
+
+
+def _client_environ(scope):
+    """Environ WSGI réduit à ce qu'il faut pour identifier le client"""
+    environ = {'REMOTE_ADDR': scope['client'][0] if scope.get('client') else None}
+    for name, value in scope.get('headers', []):
+        if name in (b'x-api-key', b'x-forwarded-for'):
+            key = 'HTTP_' + name.decode('latin1').upper().replace('-', '_')
+            value = value.decode('latin1')
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def _send_json(send, status, payload, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), *headers
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def _read_body(receive, max_length):
+    """Lit le corps de la requête; None s'il dépasse `max_length`"""
+    chunks = []
+    length = 0
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            raise ClientDisconnected()
+        chunk = message.get('body', b'')
+        length += len(chunk)
+        if max_length and length > max_length:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            _get_client()
+            # Billet d'exemple rendu avant le premier trafic, hors de la boucle d'événements
+            await asyncio.get_running_loop().run_in_executor(None, warm_up_worker)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _client is not None:
+                await _client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+
+    if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] not in RENDER_ROUTES:
+        async with ThreadSensitiveContext():
+            return await flask_application(scope, receive, send)
+
+    try:
+        body = await _read_body(receive, app.config.get('MAX_CONTENT_LENGTH'))
+    except ClientDisconnected:
+        return
+    if body is None:
+        return await _send_json(send, 413, {'error': 'Requête trop volumineuse', 'code': 413})
+
+    loop = asyncio.get_running_loop()
+    endpoint = RENDER_ROUTES[scope['path']]
+    image_urls, cost = await loop.run_in_executor(None, _image_urls, body, ADMITTED_ENDPOINTS[endpoint][0])
+    if image_urls:
+        # Débit retiré avant le téléchargement des images; Flask ne le retire pas une seconde fois
+        try:
+            await loop.run_in_executor(None, admission.charge, environ_client_id(_client_environ(scope)), cost)
+        except AdmissionRejected as e:
+            ADMISSION_REJECTED.inc(endpoint=endpoint, status=e.status)
+            return await _send_json(
+                send, e.status, {'error': e.message, 'code': e.status},
+                [(b'retry-after', str(e.retry_after).encode())]
+            )
+        prepaid_tokens.set(cost)
+        await prefetch_images_async(_get_client(), image_urls)
+
+    async def replay():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    # Le rendu (images déjà en cache) s'exécute dans un thread, hors de la boucle
+    async with _get_render_slots():
+        async with ThreadSensitiveContext():
+            await flask_application(scope, replay, send)
@@ -0,0 +1,167 @@
+"""Cache des ressources de rendu (feuilles de style, polices) partagé par le processus.
+
+Les feuilles de style sont analysées une seule fois par processus et les
+ressources distantes (Google Fonts, Font Awesome) sont conservées sur disque
+pour que les requêtes suivantes n'aient plus besoin du réseau.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from weasyprint import CSS, default_url_fetcher
+from weasyprint.text.fonts import FontConfiguration
+
+from cache import write_atomic
+
+logger = logging.getLogger(__name__)
+
+ASSET_CACHE_DIR = os.environ.get(
+    'ASSET_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'assets')
+)
+
+# WeasyPrint ignore `font-display` et émet un avertissement à chaque analyse
+FONT_DISPLAY_RE = re.compile(r'font-display\s*:\s*[^;}]+;?')
+
+# Schéma des références courtes vers les images partagées d'un lot (voir `share_data_uris`)
+SHARED_ASSET_SCHEME = 'ticket-asset:'
+
+# Configuration de polices unique, réutilisée par tous les rendus du processus
+FONT_CONFIG = FontConfiguration()
+
+_memory_cache = {}
+_stylesheets = {}
+_lock = threading.Lock()
+
+
+def _is_cacheable(mime_type):
+    """Seules les feuilles de style et les polices sont conservées"""
+    mime_type = mime_type or ''
+    return mime_type == 'text/css' or mime_type.startswith('font/') or 'font' in mime_type
+
+
+def _cache_path(url):
+    digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return os.path.join(ASSET_CACHE_DIR, digest)
+
+
+def _read_from_disk(url):
+    path = _cache_path(url)
+    try:
+        with open(path + '.json', 'r', encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+        with open(path + '.bin', 'rb') as body_file:
+            meta['string'] = body_file.read()
+        return meta
+    except (OSError, ValueError):
+        return None
+
+
+def _write_to_disk(url, result):
+    path = _cache_path(url)
+    meta = {key: value for key, value in result.items() if key != 'string'}
+    try:
+        write_atomic(path + '.bin', result['string'])
+        write_atomic(path + '.json', json.dumps(meta).encode('utf-8'))
+    except OSError as e:
+        logger.warning(f"Impossible d'écrire la ressource en cache: {e}")
+
+
+def share_data_uris(tickets, field):
+    """Remplace les data URI d'un champ par une référence courte, une par contenu distinct.
+
+    Retourne (billets, ressources) : les billets sont des copies, les
+    ressources associent chaque référence à sa data URI et sont à passer à
+    `cached_url_fetcher`. L'image n'apparaît qu'une fois dans le HTML et
+    n'est décodée qu'une fois par document.
+    """
+    shared = {}
+    references = {}
+    shared_tickets = []
+    for ticket in tickets:
+        value = ticket.get(field)
+        if isinstance(value, str) and value.startswith('data:'):
+            reference = references.get(value)
+            if reference is None:
+                digest = hashlib.sha256(value.encode('utf-8')).hexdigest()[:16]
+                reference = references[value] = f'{SHARED_ASSET_SCHEME}{digest}'
+                shared[reference] = value
+            ticket = dict(ticket, **{field: reference})
+        shared_tickets.append(ticket)
+    return shared_tickets, shared
+
+
+def cached_url_fetcher(url, timeout=10, ssl_context=None, shared_assets=None):
+    """url_fetcher WeasyPrint qui garde en cache local les CSS et polices distantes"""
+    if shared_assets and url in shared_assets:
+        return default_url_fetcher(shared_assets[url], timeout=timeout, ssl_context=ssl_context)
+
+    if not url.startswith(('http://', 'https://')):
+        return default_url_fetcher(url, timeout=timeout, ssl_context=ssl_context)
+
+    cached = _memory_cache.get(url)
+    if cached is None:
+        cached = _read_from_disk(url)
+        if cached is not None:
+            _memory_cache[url] = cached
+    if cached is not None:
+        return dict(cached)
+
+    result = default_url_fetcher(url, timeout=timeout, ssl_context=ssl_context)
+    if 'string' not in result:
+        file_obj = result.pop('file_obj')
+        try:
+            result['string'] = file_obj.read()
+        finally:
+            file_obj.close()
+
+    if not _is_cacheable(result.get('mime_type')):
+        return result
+
+    if result.get('mime_type') == 'text/css':
+        encoding = result.get('encoding') or 'utf-8'
+        css_text = result['string'].decode(encoding, errors='replace')
+        result['string'] = FONT_DISPLAY_RE.sub('', css_text).encode(encoding)
+
+    _memory_cache[url] = result
+    _write_to_disk(url, result)
+    return dict(result)
+
+
+def get_stylesheets(css_string, *urls):
+    """Retourne les feuilles de style pré-analysées, construites une seule fois par processus"""
+    key = (css_string, urls)
+    stylesheets = _stylesheets.get(key)
+    if stylesheets is not None:
+        return stylesheets
+
+    with _lock:
+        if key not in _stylesheets:
+            stylesheets = [CSS(
+                string=css_string,
+                font_config=FONT_CONFIG,
+                url_fetcher=cached_url_fetcher
+            )]
+            for url in urls:
+                try:
+                    stylesheets.append(CSS(
+                        url=url,
+                        font_config=FONT_CONFIG,
+                        url_fetcher=cached_url_fetcher
+                    ))
+                except Exception as e:
+                    logger.warning(f"Feuille de style distante indisponible ({url}): {e}")
+            _stylesheets[key] = stylesheets
+    return _stylesheets[key]
+
+
+def warm_up(css_string, *urls):
+    """Analyse les feuilles de style et rapatrie les polices avant le premier rendu"""
+    start = time.perf_counter()
+    get_stylesheets(css_string, *urls)
+    elapsed = (time.perf_counter() - start) * 1000
+    logger.info(f"Feuilles de style préchargées en {elapsed:.0f} ms")
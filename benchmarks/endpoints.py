@@ -0,0 +1,293 @@
+"""Banc d'essai reproductible des routes de rendu.
+
+Les routes `/generate-ticket`, `/generate-multiple-tickets` et
+`/preview-ticket` sont appelées via le client de test Flask. Les images
+d'événement sont servies par un serveur HTTP local (aucune dépendance à
+Unsplash ou qrserver) et les QR codes sont générés localement. Les caches
+sont placés dans un répertoire temporaire et chaque requête porte des
+références uniques, pour mesurer de vrais rendus.
+
+Usage (depuis la racine du projet) :
+    python -m benchmarks.endpoints --output bench.json
+    python -m benchmarks.endpoints --sizes 1 10 50 --baseline bench.json
+
+Sortie JSON : latences p50/p95/p99 (ms), billets par seconde et mémoire
+par route et taille de lot. La mémoire est le RSS du processus et de ses
+processus fils (pool de rendu), échantillonné pendant le cas : RSS au début
+(`rss_start_mb`), pic (`peak_rss_mb`) et hausse due au cas
+(`rss_increase_mb`). Le RSS est lu dans /proc (Linux); ailleurs, seul le pic
+du processus depuis son démarrage est disponible. Avec `--trace-memory`, le
+pic d'allocations Python par requête (tracemalloc) est aussi mesuré : il
+isole la mémoire retenue par une requête (HTML, images, PDF).
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Caches et bases isolés du reste de l'installation, définis avant l'import de l'application
+_cache_root = tempfile.mkdtemp(prefix='pdf-bench-')
+for _name in ('IMAGE_CACHE_DIR', 'ASSET_CACHE_DIR', 'RESULT_CACHE_DIR', 'JOBS_DIR', 'LOCKS_DIR'):
+    os.environ.setdefault(_name, os.path.join(_cache_root, _name.lower()))
+for _name in ('RATE_LIMIT_DB', 'IDEMPOTENCY_DB'):
+    os.environ.setdefault(_name, os.path.join(_cache_root, _name.lower() + '.sqlite3'))
+# Le banc mesure le rendu : pas de limitation de débit (le lot de 1000 dépasse la rafale)
+os.environ['RATE_LIMIT_TICKETS_PER_MINUTE'] = '0'
+
+from PIL import Image  # noqa: E402
+
+import app as service  # noqa: E402
+
+DEFAULT_SIZES = (1, 10, 50, 200, 1000)
+
+
+class ImageStubHandler(BaseHTTPRequestHandler):
+    """Sert une image JPEG fixe, avec une latence simulée optionnelle"""
+
+    image = b''
+    latency = 0.0
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(self.image)))
+        self.send_header('ETag', '"bench-image"')
+        self.end_headers()
+        self.wfile.write(self.image)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_image_stub(latency_ms):
+    """Démarre le serveur d'images local et retourne son URL"""
+    buffer = io.BytesIO()
+    Image.effect_noise((2400, 1600), 64).convert('RGB').save(buffer, format='JPEG', quality=90)
+    ImageStubHandler.image = buffer.getvalue()
+    ImageStubHandler.latency = latency_ms / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}/event.jpg'
+
+
+def make_ticket(image_url, run_id, index):
+    reference = f'#BENCH-{run_id}-{index:05d}'
+    return {
+        'event_title': 'FESTIVAL DE MUSIQUE ÉLECTRONIQUE',
+        'event_date_time': 'Samedi 25 Août 2023 à 20h',
+        'event_location': 'LA GRANDE SCÈNE',
+        'event_address': "123 Boulevard de l'Événement, 75000 Paris",
+        'organizer_name': 'MFUMUENTERTAINMENT',
+        'ticket_price': '49 FCFA',
+        'ticket_type': 'VIP',
+        'reference': reference,
+        'qr_payload': reference,
+        'event_image_url': image_url,
+    }
+
+
+def percentile(values, rank):
+    """Percentile au rang le plus proche"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(rank / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def lifetime_peak_rss_mb():
+    # ru_maxrss est en kilo-octets sous Linux, en octets sous macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _process_rss(pid):
+    """RSS d'un processus en octets (0 s'il s'est terminé entre-temps)"""
+    try:
+        with open(f'/proc/{pid}/status', 'r', encoding='ascii') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _descendants(root):
+    """Processus fils (et leurs descendants) de `root`, d'après /proc/<pid>/stat"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r', encoding='ascii', errors='replace') as stat_file:
+                # Le nom du processus, entre parenthèses, peut contenir des espaces
+                parent = int(stat_file.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    pending, found = [root], []
+    while pending:
+        for child in children.get(pending.pop(), []):
+            found.append(child)
+            pending.append(child)
+    return found
+
+
+def tree_rss():
+    """RSS du processus et de ses descendants (pool de rendu), en octets"""
+    pid = os.getpid()
+    return sum(_process_rss(process) for process in [pid] + _descendants(pid))
+
+
+class RssSampler:
+    """Échantillonne le RSS du processus et de ses fils pendant un cas (pic et valeur initiale)"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.available = os.path.exists(f'/proc/{os.getpid()}/status')
+        self.start_bytes = self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.available:
+            self.start_bytes = self.peak_bytes = tree_rss()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, tree_rss())
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak_bytes = max(self.peak_bytes, tree_rss())
+        return False
+
+    def describe(self):
+        if not self.available:
+            return {'peak_rss_mb': lifetime_peak_rss_mb()}
+        megabytes = 1024 * 1024
+        return {
+            'rss_start_mb': round(self.start_bytes / megabytes, 1),
+            'peak_rss_mb': round(self.peak_bytes / megabytes, 1),
+            'rss_increase_mb': round((self.peak_bytes - self.start_bytes) / megabytes, 1),
+        }
+
+
+def run_case(client, route, image_url, size, iterations, trace_memory=False):
+    latencies = []
+    peak_allocations = []
+    sampler = RssSampler()
+    with sampler:
+        for _ in range(iterations):
+            run_id = uuid.uuid4().hex[:8]
+            if route == '/generate-multiple-tickets':
+                payload = {'tickets': [make_ticket(image_url, run_id, i) for i in range(size)]}
+            else:
+                payload = {'ticket': make_ticket(image_url, run_id, 0)}
+
+            if trace_memory:
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            response = client.post(route, json=payload)
+            body_size = len(response.get_data())
+            latencies.append(time.perf_counter() - start)
+            # Termine la réponse (et libère son emplacement de rendu) avant la requête suivante
+            response.close()
+            if trace_memory:
+                # Le corps de la réponse est lu en entier par le client de test : exclu du pic
+                peak_allocations.append(tracemalloc.get_traced_memory()[1] - baseline - body_size)
+            if response.status_code != 200:
+                raise RuntimeError(f'{route} ({size} billets): HTTP {response.status_code} {response.get_data()[:200]!r}')
+
+    total = sum(latencies)
+    case = {
+        'route': route,
+        'batch_size': size,
+        'iterations': iterations,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'tickets_per_second': round(size * iterations / total, 2),
+        'response_bytes': body_size,
+    }
+    # RSS du processus et du pool de rendu pendant ce cas
+    case.update(sampler.describe())
+    if trace_memory:
+        case['peak_request_alloc_mb'] = round(max(peak_allocations) / (1024 * 1024), 1)
+    return case
+
+
+def compare(results, baseline_path):
+    """Ajoute à chaque cas le rapport p50 / p50 de référence"""
+    with open(baseline_path, 'r', encoding='utf-8') as baseline_file:
+        baseline = json.load(baseline_file)
+    reference = {(case['route'], case['batch_size']): case for case in baseline['cases']}
+    for case in results['cases']:
+        previous = reference.get((case['route'], case['batch_size']))
+        if previous:
+            case['p50_vs_baseline'] = round(case['p50_ms'] / previous['p50_ms'], 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Banc d\'essai des routes de rendu')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='tailles de lot pour /generate-multiple-tickets')
+    parser.add_argument('--iterations', type=int, default=5,
+                        help='requêtes par cas (réduites automatiquement pour les gros lots)')
+    parser.add_argument('--image-latency', type=float, default=0,
+                        help='latence simulée du serveur d\'images (ms)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='mesure le pic d\'allocations Python par requête (plus lent)')
+    parser.add_argument('--output', help='fichier JSON de sortie (sinon stdout)')
+    parser.add_argument('--baseline', help='résultats de référence à comparer')
+    args = parser.parse_args()
+
+    image_url = start_image_stub(args.image_latency)
+    client = service.app.test_client()
+    if args.trace_memory:
+        tracemalloc.start()
+
+    cases = [
+        run_case(client, '/preview-ticket', image_url, 1, args.iterations, args.trace_memory),
+        run_case(client, '/generate-ticket', image_url, 1, args.iterations, args.trace_memory),
+    ]
+    for size in args.sizes:
+        iterations = max(1, min(args.iterations, 200 // size))
+        cases.append(run_case(
+            client, '/generate-multiple-tickets', image_url, size, iterations, args.trace_memory
+        ))
+
+    results = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'cpu_count': os.cpu_count(),
+        'cases': cases,
+    }
+    if args.baseline:
+        compare(results, args.baseline)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
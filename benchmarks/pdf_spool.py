@@ -0,0 +1,105 @@
+"""Pic de mémoire du chemin de sortie d'un PDF : rendu → cache de résultats → réponse.
+
+Le document est remplacé par un PDF synthétique de taille fixe, écrit par
+blocs de 16 Kio comme le fait pydyf : la mise en page WeasyPrint est exclue
+de la mesure. Pour chaque taille, le PDF est écrit dans un `BytesIO` (ancien
+chemin) puis dans un `SpooledTemporaryFile(max_size=PDF_SPOOL_THRESHOLD)`,
+stocké dans le cache de résultats et envoyé par `send_cached_file`. Le pic
+d'allocations Python (tracemalloc) est mesuré sur l'ensemble.
+
+Le banc échoue (code de sortie 1) si, avec le fichier temporaire, le pic
+dépasse PDF_SPOOL_THRESHOLD + `--margin` pour une taille quelconque, au-dessus
+comme en dessous du seuil.
+
+Usage (depuis la racine du projet) :
+    python -m benchmarks.pdf_spool
+    python -m benchmarks.pdf_spool --sizes-mb 1 2 8 32 --margin-mb 1
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+import uuid
+
+# Cache de résultats isolé du reste de l'installation, défini avant l'import de l'application
+_cache_root = tempfile.mkdtemp(prefix='pdf-spool-bench-')
+os.environ.setdefault('RESULT_CACHE_DIR', os.path.join(_cache_root, 'result_cache_dir'))
+
+import app as service  # noqa: E402
+import result_cache  # noqa: E402
+
+DEFAULT_SIZES_MB = (1, 2, 8, 32)
+BLOCK_SIZE = 16 * 1024
+MB = 1024 * 1024
+
+# Bloc réutilisé pour chaque écriture : le contenu synthétique n'alloue rien pendant la mesure
+_BLOCK = os.urandom(BLOCK_SIZE)
+
+
+def write_synthetic_pdf(target, size):
+    """Écrit un PDF d'environ `size` octets dans `target`, par blocs"""
+    target.write(b'%PDF-1.7\n%' + uuid.uuid4().hex.encode('ascii') + b'\n')
+    for _ in range(size // BLOCK_SIZE):
+        target.write(_BLOCK)
+    target.write(b'\n%%EOF\n')
+
+
+def measure(size, spooled):
+    """Pic d'allocations (octets) pour rendre, mettre en cache et envoyer un PDF de `size` octets"""
+    key = uuid.uuid4().hex
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    if spooled:
+        pdf_file = tempfile.SpooledTemporaryFile(max_size=service.PDF_SPOOL_THRESHOLD)
+    else:
+        pdf_file = io.BytesIO()
+    write_synthetic_pdf(pdf_file, size)
+    result_cache.store(key, pdf_file)
+    with service.app.test_request_context():
+        response = service.send_cached_file(pdf_file, 'billets.pdf', key)
+        sent = 0
+        for block in response.response:
+            sent += len(block)
+        response.close()
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    assert sent >= size, (sent, size)
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes-mb', type=float, nargs='+', default=DEFAULT_SIZES_MB)
+    parser.add_argument('--margin-mb', type=float, default=1.0,
+                        help="marge tolérée au-dessus du seuil pour le fichier temporaire")
+    args = parser.parse_args()
+
+    threshold = service.PDF_SPOOL_THRESHOLD
+    limit = threshold + args.margin_mb * MB
+    tracemalloc.start()
+    # Une première passe hors mesure (imports paresseux, connexions du cache)
+    measure(BLOCK_SIZE, spooled=True)
+
+    results = []
+    for size_mb in args.sizes_mb:
+        size = int(size_mb * MB)
+        results.append({
+            'pdf_mb': size_mb,
+            'above_threshold': size > threshold,
+            'bytesio_peak_mb': round(measure(size, spooled=False) / MB, 1),
+            'spooled_peak_mb': round(measure(size, spooled=True) / MB, 1),
+        })
+    tracemalloc.stop()
+    print(json.dumps({'spool_threshold_mb': round(threshold / MB, 1), 'results': results}, indent=2))
+
+    over = [result for result in results if result['spooled_peak_mb'] * MB > limit]
+    if over:
+        print(f"Pic au-delà de {limit / MB:.1f} Mo avec le fichier temporaire: "
+              f"{', '.join(str(result['pdf_mb']) for result in over)} Mo", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Compare le temps de rendu par billet : chemin historique vs moteur précompilé.
+
+Chemin historique : `render_template_string` + `CSS(string=<css du design>)` +
+`HTML(...).write_pdf()` à chaque billet (recompilation Jinja, réanalyse CSS,
+polices distantes). Moteur : `TicketRenderer.render_ticket_pdf`.
+
+Usage (depuis la racine du projet) :
+    python -m benchmarks.render_engine --iterations 20
+"""
+import argparse
+import json
+import statistics
+import time
+
+from flask import render_template_string
+from weasyprint import CSS, HTML
+
+import app as service
+
+
+def sample_ticket(index):
+    return service.validate_ticket_data({
+        'event_title': 'FESTIVAL DE MUSIQUE ÉLECTRONIQUE',
+        'event_date_time': 'Samedi 25 Août 2023 à 20h',
+        'event_location': 'LA GRANDE SCÈNE',
+        'event_address': "123 Boulevard de l'Événement, 75000 Paris",
+        'organizer_name': 'MFUMUENTERTAINMENT',
+        'ticket_price': '49 FCFA',
+        'ticket_type': 'VIP',
+        'reference': f'#EVT2023-{index:04d}',
+        'qr_payload': f'EVT2023-{index:04d}',
+    })
+
+
+def render_legacy(ticket):
+    """Reproduit le chemin de rendu d'origine des routes"""
+    css, single_template = service.designs.get().spec[:2]
+    with service.app.test_request_context():
+        html_content = render_template_string(single_template, ticket=ticket)
+    css_doc = CSS(string=css)
+    return HTML(string=html_content).write_pdf(stylesheets=[css_doc])
+
+
+def render_engine(ticket):
+    return service.designs.get().render_ticket_pdf(ticket)
+
+
+def measure(render, iterations):
+    timings = []
+    for index in range(iterations):
+        ticket = sample_ticket(index)
+        start = time.perf_counter()
+        render(ticket)
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        'iterations': iterations,
+        'median_ms': round(statistics.median(timings), 2),
+        'mean_ms': round(statistics.mean(timings), 2),
+        'min_ms': round(min(timings), 2),
+        'max_ms': round(max(timings), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    # Un premier rendu de chaque chemin, hors mesure
+    render_legacy(sample_ticket(0))
+    render_engine(sample_ticket(0))
+
+    results = {
+        'legacy': measure(render_legacy, args.iterations),
+        'engine': measure(render_engine, args.iterations),
+    }
+    results['speedup'] = round(results['legacy']['median_ms'] / results['engine']['median_ms'], 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
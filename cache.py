@@ -0,0 +1,296 @@
+"""Caches partagés du service : LRU mémoire borné en octets et stockage disque adressé par contenu.
+
+Le stockage disque est partagé entre les workers gunicorn : les écritures
+sont atomiques (fichier temporaire puis `os.replace`) et l'éviction se base
+sur la date de dernier accès des objets. Le budget compte aussi les fichiers
+d'index, supprimés avec les objets qu'ils désignent.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Les contenus fournis sous forme de fichier sont lus et copiés par blocs
+COPY_BLOCK_SIZE = 256 * 1024
+
+
+def write_atomic(path, data):
+    """Écrit un fichier de façon atomique (sûr entre plusieurs workers).
+
+    `data` est une chaîne d'octets ou un fichier binaire, copié par blocs
+    depuis sa position courante.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            if hasattr(data, 'read'):
+                shutil.copyfileobj(data, tmp_file, COPY_BLOCK_SIZE)
+            else:
+                tmp_file.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def content_digest(data):
+    """Empreinte SHA-256 et taille d'un contenu (octets, ou fichier lu depuis le début)"""
+    if not hasattr(data, 'read'):
+        return hashlib.sha256(data).hexdigest(), len(data)
+    digest = hashlib.sha256()
+    size = 0
+    data.seek(0)
+    for block in iter(lambda: data.read(COPY_BLOCK_SIZE), b''):
+        digest.update(block)
+        size += len(block)
+    return digest.hexdigest(), size
+
+
+class LRUCache:
+    """Cache mémoire LRU borné par un budget en octets"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def delete(self, key):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous[1]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache:
+    """Stockage disque adressé par contenu avec index par clé et éviction LRU.
+
+    Chaque clé pointe vers un fichier d'index JSON (métadonnées + empreinte
+    SHA-256 du contenu); le contenu lui-même est stocké une seule fois sous
+    son empreinte, même s'il est référencé par plusieurs clés.
+    """
+
+    EVICTION_INTERVAL = 30
+    # Balayage complet des index (index orphelins, contenus non référencés), même sous le budget
+    SWEEP_INTERVAL = 600
+    # Âge minimal d'un contenu non référencé avant suppression : son index peut être en cours d'écriture
+    ORPHAN_GRACE = 60
+
+    def __init__(self, directory, max_bytes, max_age=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Durée de vie des entrées (secondes, d'après `stored_at`); None : pas d'expiration
+        self.max_age = max_age
+        self._last_eviction = 0.0
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+
+    def _index_path(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'index', digest[:2], digest + '.json')
+
+    def _object_path(self, content_hash):
+        return os.path.join(self.directory, 'objects', content_hash[:2], content_hash)
+
+    def get_meta(self, key):
+        """Retourne les métadonnées associées à une clé, ou None"""
+        try:
+            with open(self._index_path(key), 'r', encoding='utf-8') as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            return None
+
+    def set_meta(self, key, meta):
+        try:
+            write_atomic(self._index_path(key), json.dumps(meta).encode('utf-8'))
+        except OSError as e:
+            logger.warning(f"Impossible d'écrire l'index du cache: {e}")
+
+    def read(self, content_hash):
+        """Lit un contenu par son empreinte et met à jour sa date d'accès"""
+        path = self._object_path(content_hash)
+        try:
+            with open(path, 'rb') as object_file:
+                data = object_file.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def open(self, content_hash):
+        """Ouvre un contenu en lecture binaire (pour les réponses en flux), ou None"""
+        path = self._object_path(content_hash)
+        try:
+            object_file = open(path, 'rb')
+            os.utime(path)
+            return object_file
+        except OSError:
+            return None
+
+    def get(self, key):
+        """Retourne (métadonnées, contenu) pour une clé, ou (None, None)"""
+        meta = self.get_meta(key)
+        if meta is None:
+            return None, None
+        data = self.read(meta['content_hash'])
+        if data is None:
+            return None, None
+        return meta, data
+
+    def set(self, key, data, meta=None):
+        """Stocke un contenu (octets ou fichier binaire) sous une clé et retourne les
+        métadonnées enregistrées"""
+        content_hash, size = content_digest(data)
+        meta = dict(meta or {})
+        meta['content_hash'] = content_hash
+        meta['size'] = size
+        path = self._object_path(content_hash)
+        try:
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                if hasattr(data, 'seek'):
+                    data.seek(0)
+                write_atomic(path, data)
+        except OSError as e:
+            logger.warning(f"Impossible d'écrire dans le cache disque: {e}")
+            return meta
+        self.set_meta(key, meta)
+        self._maybe_evict()
+        return meta
+
+    def delete(self, key):
+        try:
+            os.unlink(self._index_path(key))
+        except OSError:
+            pass
+
+    def _maybe_evict(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_eviction < self.EVICTION_INTERVAL:
+                return
+            self._last_eviction = now
+            sweep = now - self._last_sweep >= self.SWEEP_INTERVAL
+            if sweep:
+                self._last_sweep = now
+        self.evict(sweep=sweep)
+
+    def _files(self, subdirectory):
+        """Fichiers d'un sous-répertoire du cache : [(date de modification, taille, chemin)]"""
+        files = []
+        for root, _, names in os.walk(os.path.join(self.directory, subdirectory)):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+            return True
+        except OSError:
+            return False
+
+    def _read_index(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as index_file:
+                meta = json.load(index_file)
+            return meta if isinstance(meta, dict) and 'content_hash' in meta else None
+        except (OSError, ValueError):
+            return None
+
+    def _index_is_stale(self, meta, now):
+        """Index à supprimer au balayage (illisible ou expiré)"""
+        if meta is None:
+            return True
+        return self.max_age is not None and now - meta.get('stored_at', 0) > self.max_age
+
+    def evict(self, sweep=True):
+        """Supprime les contenus les moins récemment utilisés au-delà du budget, avec leurs index.
+
+        Le budget compte les contenus et les fichiers d'index. Un balayage
+        (`sweep`, ou dépassement du budget) lit aussi les index : les index
+        périmés ou orphelins et les contenus qu'aucun index ne référence
+        sont supprimés.
+        """
+        objects = self._files('objects')
+        indexes = self._files('index')
+        total = sum(size for _, size, _ in objects) + sum(size for _, size, _ in indexes)
+        if not sweep and total <= self.max_bytes:
+            return
+
+        now = time.time()
+        object_names = {os.path.basename(path) for _, _, path in objects}
+        references = {}
+        for mtime, size, path in indexes:
+            if not path.endswith('.json'):
+                # Fichier temporaire d'une écriture interrompue
+                if now - mtime > self.ORPHAN_GRACE and self._unlink(path):
+                    total -= size
+                continue
+            meta = self._read_index(path)
+            if self._index_is_stale(meta, now) or meta['content_hash'] not in object_names:
+                if self._unlink(path):
+                    total -= size
+                continue
+            references.setdefault(meta['content_hash'], []).append((size, path))
+
+        candidates = []
+        for mtime, size, path in objects:
+            if os.path.basename(path) in references:
+                candidates.append((mtime, size, path))
+            elif now - mtime > self.ORPHAN_GRACE and self._unlink(path):
+                total -= size
+
+        if total <= self.max_bytes:
+            return
+        candidates.sort()
+        for _, size, path in candidates:
+            if total <= self.max_bytes:
+                break
+            if not self._unlink(path):
+                continue
+            total -= size
+            for index_size, index_path in references[os.path.basename(path)]:
+                if self._unlink(index_path):
+                    total -= index_size
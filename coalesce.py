@@ -0,0 +1,72 @@
+"""Coalescence des rendus identiques simultanés (single-flight).
+
+Une requête qui va rendre un résultat prend d'abord un verrou exclusif sur
+sa clé de cache; les requêtes identiques arrivées pendant le rendu
+attendent ce verrou puis trouvent le résultat dans le cache au lieu de le
+rendre à nouveau. Le verrou est un fichier verrouillé avec `flock` : il est
+partagé entre les threads et entre les workers gunicorn.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows : coalescence limitée au processus
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LOCKS_DIR = os.environ.get(
+    'LOCKS_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'locks')
+)
+# Attente maximale du rendu d'une requête identique, en secondes (au-delà : rendu sans attendre)
+COALESCE_WAIT = float(os.environ.get('COALESCE_WAIT', 60))
+
+# Nombre fixe de fichiers de verrou : les clés sont réparties sur ces fichiers
+LOCK_STRIPES = 4096
+POLL_INTERVAL = 0.05
+
+_thread_locks = [threading.Lock() for _ in range(LOCK_STRIPES)] if fcntl is None else None
+
+
+def _stripe(key):
+    return int(hashlib.sha256(key.encode('utf-8')).hexdigest()[:8], 16) % LOCK_STRIPES
+
+
+@contextmanager
+def hold(key, timeout=COALESCE_WAIT):
+    """Verrou exclusif par clé; après `timeout` secondes d'attente, continue sans verrou"""
+    stripe = _stripe(key)
+    if fcntl is None:
+        acquired = _thread_locks[stripe].acquire(timeout=timeout)
+        try:
+            yield
+        finally:
+            if acquired:
+                _thread_locks[stripe].release()
+        return
+
+    os.makedirs(LOCKS_DIR, exist_ok=True)
+    # Un descripteur par acquisition : deux threads du même processus s'excluent aussi
+    lock_file = open(os.path.join(LOCKS_DIR, f'{stripe:04x}.lock'), 'a+b')
+    try:
+        deadline = time.monotonic() + timeout
+        acquired = False
+        while not acquired:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                acquired = True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    logger.warning(f"Attente du rendu identique dépassée ({timeout:g} s), rendu sans coalescence")
+                    break
+                time.sleep(POLL_INTERVAL)
+        yield
+    finally:
+        # La fermeture libère le verrou
+        lock_file.close()
@@ -0,0 +1,142 @@
+"""Registre des designs de billets.
+
+Chaque design est un dossier de `templates/` contenant un `manifest.json` :
+
+    {
+      "name": "Billet standard",
+      "version": "1",
+      "css": "ticket.css",
+      "single": "ticket.html",
+      "multiple": "tickets.html",
+      "icons_url": "https://..."          (optionnel)
+    }
+
+Les designs sont chargés au démarrage : templates Jinja compilés et
+feuilles de style analysées une fois par design. Le registre vérifie
+périodiquement les manifestes et recharge un design dont la version a
+changé (ou un nouveau dossier), sans redémarrer le service. La version
+entre dans la version du moteur, donc dans les clés du cache de résultats.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from render_engine import TicketRenderer
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES_DIR = os.environ.get(
+    'TEMPLATES_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+)
+DEFAULT_DESIGN = os.environ.get('DEFAULT_DESIGN', 'default')
+# Intervalle de vérification des manifestes, en secondes (0 désactive le rechargement)
+TEMPLATE_RELOAD_INTERVAL = float(os.environ.get('TEMPLATE_RELOAD_INTERVAL', 5))
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def _read_text(directory, name):
+    with open(os.path.join(directory, name), 'r', encoding='utf-8') as source_file:
+        return source_file.read()
+
+
+def load_design(directory):
+    """Construit et préchauffe le moteur de rendu d'un dossier de design"""
+    with open(os.path.join(directory, MANIFEST_NAME), 'r', encoding='utf-8') as manifest_file:
+        manifest = json.load(manifest_file)
+    renderer = TicketRenderer(
+        _read_text(directory, manifest.get('css', 'ticket.css')),
+        _read_text(directory, manifest.get('single', 'ticket.html')),
+        _read_text(directory, manifest.get('multiple', 'tickets.html')),
+        icons_url=manifest.get('icons_url'),
+        design=os.path.basename(directory),
+        design_version=str(manifest.get('version', '')),
+    )
+    renderer.warm_up()
+    return renderer
+
+
+class DesignRegistry:
+    """Moteurs de rendu précompilés, un par design, rechargés à chaud"""
+
+    def __init__(self, directory=TEMPLATES_DIR, default=DEFAULT_DESIGN,
+                 reload_interval=TEMPLATE_RELOAD_INTERVAL):
+        self.directory = directory
+        self.default = default
+        self.reload_interval = reload_interval
+        self._renderers = {}
+        self._manifest_mtimes = {}
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Charge les designs au démarrage; le design par défaut est obligatoire"""
+        with self._lock:
+            self._scan()
+        if self.default not in self._renderers:
+            raise RuntimeError(f"Design par défaut introuvable: {self.default} ({self.directory})")
+
+    def _scan(self):
+        """Charge (ou recharge) les designs dont le manifeste est nouveau ou modifié"""
+        self._last_check = time.monotonic()
+        try:
+            names = sorted(os.listdir(self.directory))
+        except OSError as e:
+            logger.error(f"Dossier des designs illisible ({self.directory}): {e}")
+            return
+        for name in names:
+            manifest_path = os.path.join(self.directory, name, MANIFEST_NAME)
+            try:
+                mtime = os.stat(manifest_path).st_mtime
+            except OSError:
+                continue
+            if self._manifest_mtimes.get(name) == mtime:
+                continue
+            self._manifest_mtimes[name] = mtime
+            self._load_one(name)
+
+    def _load_one(self, name):
+        current = self._renderers.get(name)
+        try:
+            start = time.perf_counter()
+            renderer = load_design(os.path.join(self.directory, name))
+        except Exception as e:
+            # Un design invalide ne remplace pas la version déjà en service
+            logger.error(f"Design {name} non chargé: {e}", exc_info=True)
+            return
+        if current is not None and current.version == renderer.version:
+            return
+        self._renderers[name] = renderer
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.info(f"Design {name} v{renderer.design_version} chargé en {elapsed:.0f} ms")
+
+    def _maybe_reload(self):
+        if not self.reload_interval or time.monotonic() - self._last_check < self.reload_interval:
+            return
+        # Un seul thread recharge; les autres requêtes continuent avec les moteurs en place
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._scan()
+        finally:
+            self._lock.release()
+
+    def get(self, design=None):
+        """Moteur de rendu d'un design (design par défaut si non précisé)"""
+        self._maybe_reload()
+        if design is not None and not isinstance(design, str):
+            raise ValueError("Le champ design doit être un identifiant de design")
+        renderer = self._renderers.get(design or self.default)
+        if renderer is None:
+            raise ValueError(f"Design inconnu: {design}")
+        return renderer
+
+    def describe(self):
+        """Designs disponibles et leur version (pour /health)"""
+        return {
+            name: {'version': renderer.design_version, 'engine_version': renderer.version}
+            for name, renderer in sorted(self._renderers.items())
+        }
@@ -0,0 +1,82 @@
+"""Configuration gunicorn du service.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+L'application est préchargée dans le processus maître (import de
+WeasyPrint, cairo et fontTools, chargement des designs, feuilles de style
+et polices distantes) puis partagée par fork avec les workers. Chaque
+worker rend ensuite un billet d'exemple avant d'accepter sa première
+requête : aucune requête ne paie le démarrage à froid.
+"""
+import logging
+import os
+import time
+
+logger = logging.getLogger('gunicorn.error')
+
+# La configuration est lue avant le préchargement de l'application (`on_starting` vient après)
+BOOT_STARTED = time.perf_counter()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Métriques additionnées sur tous les workers : chaque worker écrit les siennes dans ce
+# répertoire (défini avant le préchargement, qui importe metrics.py)
+os.environ.setdefault(
+    'METRICS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'metrics')
+)
+
+# Rendu limité par le CPU : un worker par cœur. Les threads sont plus nombreux que les
+# emplacements de rendu (RENDER_SLOTS) : les threads libres téléchargent les images,
+# envoient les réponses et refusent vite les requêtes en surcharge (429/503). WeasyPrint
+# n'est pas thread-safe : la mise en page reste sérialisée dans le worker (render_engine)
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+# Les gros lots sont rendus en flux, mais un lot non streamé peut dépasser 30 s
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# Recyclage périodique : borne la mémoire conservée par WeasyPrint d'un rendu à l'autre
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+
+
+def on_starting(server):
+    # Les compteurs repartent de zéro à chaque démarrage du serveur
+    from metrics import reset
+
+    reset()
+
+
+def when_ready(server):
+    elapsed = time.perf_counter() - BOOT_STARTED
+    logger.info(f"Serveur prêt en {elapsed:.2f} s (préchargement: {'oui' if preload_app else 'non'})")
+
+
+def post_fork(server, worker):
+    worker.boot_started = time.perf_counter()
+
+
+def post_worker_init(worker):
+    """Préchauffe le worker avant qu'il n'accepte des connexions"""
+    # Import différé : avec preload_app l'application est déjà chargée, sinon elle l'est ici
+    from app import warm_up_worker, worker_state
+    from metrics import start_flusher
+
+    start_flusher()
+
+    # Un échec du rendu d'exemple laisse le worker servir, déclaré prêt en mode dégradé
+    warm_up_worker(boot_started=worker.boot_started)
+    state = ' (dégradé : préchauffage en échec)' if worker_state['degraded'] else ''
+    logger.info(f"Worker {worker.pid} prêt en {worker_state['boot_ms']:.0f} ms{state}")
+
+
+def worker_exit(server, worker):
+    # Dernières valeurs du worker, reportées dans l'archive au prochain /metrics
+    from metrics import flush
+
+    flush()
@@ -0,0 +1,99 @@
+"""Clés d'idempotence (`Idempotency-Key`).
+
+Une clé fournie par le client est associée, pour IDEMPOTENCY_TTL secondes,
+à l'empreinte de la première requête qui l'a utilisée (et à son résultat,
+par exemple l'identifiant d'une tâche). Une nouvelle tentative avec la même
+clé et la même requête rejoue ce résultat; la même clé avec une requête
+différente est refusée. Les enregistrements sont dans SQLite, partagés
+entre les workers.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+IDEMPOTENCY_DB = os.environ.get(
+    'IDEMPOTENCY_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'idempotency.sqlite3')
+)
+# Fenêtre pendant laquelle une nouvelle tentative est rejouée, en secondes
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 3600))
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+
+class IdempotencyConflict(Exception):
+    """Clé d'idempotence déjà utilisée pour une requête différente"""
+
+
+class IdempotencyStore:
+    PURGE_INTERVAL = 300
+
+    def __init__(self, path=IDEMPOTENCY_DB, ttl=IDEMPOTENCY_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._last_purge = 0.0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connect().execute("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                result TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+
+    def _connect(self):
+        """Une connexion par thread (les connexions sqlite3 ne se partagent pas)"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def claim(self, key, fingerprint):
+        """Réserve la clé pour cette requête.
+
+        Retourne le résultat déjà enregistré (None s'il n'y en a pas encore)
+        et un booléen indiquant s'il s'agit d'une nouvelle tentative; lève
+        IdempotencyConflict si la clé sert déjà à une autre requête.
+        """
+        now = time.time()
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                "SELECT fingerprint, result FROM idempotency_keys WHERE key = ? AND created_at >= ?",
+                (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, result, created_at) "
+                    "VALUES (?, ?, NULL, ?)",
+                    (key, fingerprint, now)
+                )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        self._maybe_purge(now)
+        if row is None:
+            return None, False
+        if row[0] != fingerprint:
+            raise IdempotencyConflict("Idempotency-Key déjà utilisée pour une requête différente")
+        return row[1], True
+
+    def set_result(self, key, result):
+        self._connect().execute(
+            "UPDATE idempotency_keys SET result = ? WHERE key = ?", (result, key)
+        )
+
+    def _maybe_purge(self, now):
+        if now - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        self._connect().execute(
+            "DELETE FROM idempotency_keys WHERE created_at < ?", (now - self.ttl,)
+        )
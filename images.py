@@ -0,0 +1,364 @@
+"""Téléchargement des images d'événement et conversion en URL data.
+
+Les images distantes passent par un cache à deux niveaux : un LRU mémoire
+borné en octets (par worker) et un stockage disque adressé par contenu
+partagé entre les workers. Une entrée expirée (IMAGE_CACHE_TTL) est
+revalidée avec ETag / Last-Modified plutôt que retéléchargée.
+
+Avant d'être mises en cache, les images matricielles sont normalisées :
+réduites à la taille imprimée du bandeau (IMAGE_DPI), débarrassées de leurs
+métadonnées et réencodées en JPEG (ou PNG si transparence).
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter
+
+from cache import DiskCache, LRUCache
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FETCH_WORKERS = int(os.environ.get('IMAGE_FETCH_WORKERS', 8))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get('IMAGE_FETCH_TIMEOUT', 10))
+
+IMAGE_CACHE_DIR = os.environ.get(
+    'IMAGE_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'images')
+)
+IMAGE_CACHE_TTL = int(os.environ.get('IMAGE_CACHE_TTL', 3600))
+IMAGE_CACHE_MEMORY_BYTES = int(os.environ.get('IMAGE_CACHE_MEMORY_BYTES', 64 * 1024 * 1024))
+IMAGE_CACHE_DISK_BYTES = int(os.environ.get('IMAGE_CACHE_DISK_BYTES', 512 * 1024 * 1024))
+
+IMAGE_DPI = int(os.environ.get('IMAGE_DPI', 200))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 82))
+
+# Dimensions imprimées du bandeau `.ticket-left` (largeur, hauteur) en mm
+BANNER_SIZE_MM = (50, 70)
+
+# Profil de normalisation : fait partie des clés de cache
+NORMALISATION_PROFILE = f"banner-{BANNER_SIZE_MM[0]}x{BANNER_SIZE_MM[1]}mm@{IMAGE_DPI}dpi-q{IMAGE_JPEG_QUALITY}"
+
+HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+}
+
+
+def _build_session():
+    """Session HTTP partagée avec un pool de connexions réutilisables"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=IMAGE_FETCH_WORKERS, pool_maxsize=IMAGE_FETCH_WORKERS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(HTTP_HEADERS)
+    return session
+
+
+http_session = _build_session()
+
+memory_cache = LRUCache(IMAGE_CACHE_MEMORY_BYTES)
+disk_cache = DiskCache(IMAGE_CACHE_DIR, IMAGE_CACHE_DISK_BYTES)
+
+_stats = {
+    'memory_hits': 0,
+    'disk_hits': 0,
+    'revalidated': 0,
+    'misses': 0,
+    'errors': 0,
+    'normalised_bytes_saved': 0,
+}
+_stats_lock = threading.Lock()
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Pool de téléchargement, recréé après un fork (workers gunicorn)"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=IMAGE_FETCH_WORKERS,
+                thread_name_prefix='image-fetch'
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _count(name, value=1):
+    with _stats_lock:
+        _stats[name] += value
+
+
+def image_cache_stats():
+    """Compteurs du cache d'images (propres au worker courant)"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['memory_entries'] = len(memory_cache)
+    stats['memory_bytes'] = memory_cache.current_bytes
+    return stats
+
+
+def _to_data_uri(content_type, data):
+    image_base64 = base64.b64encode(data).decode('utf-8')
+    return f"data:{content_type};base64,{image_base64}"
+
+
+def _target_size():
+    """Taille en pixels du bandeau imprimé à IMAGE_DPI"""
+    return tuple(round(mm / 25.4 * IMAGE_DPI) for mm in BANNER_SIZE_MM)
+
+
+def normalise_image(data, content_type):
+    """Réduit l'image à la taille imprimée et la réencode sans métadonnées.
+
+    Le bandeau est affiché en `object-fit: cover` centré : l'image est
+    réduite pour couvrir la zone puis recadrée au centre, ce qui ne change
+    pas le rendu. Retourne (données, type MIME); l'image d'origine est
+    conservée si elle ne peut pas être décodée ou si le résultat est plus lourd.
+    """
+    if 'svg' in content_type:
+        return data, content_type
+
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            image = ImageOps.exif_transpose(source)
+            target_width, target_height = _target_size()
+            scale = max(target_width / image.width, target_height / image.height)
+            resized = scale < 1
+            if resized:
+                image = image.resize(
+                    (max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                    Image.Resampling.LANCZOS
+                )
+            if image.width > target_width or image.height > target_height:
+                left = (image.width - min(image.width, target_width)) // 2
+                top = (image.height - min(image.height, target_height)) // 2
+                image = image.crop((
+                    left, top,
+                    left + min(image.width, target_width),
+                    top + min(image.height, target_height)
+                ))
+                resized = True
+
+            has_alpha = image.mode in ('RGBA', 'LA') or (
+                image.mode == 'P' and 'transparency' in image.info
+            )
+            output = io.BytesIO()
+            if has_alpha:
+                image.save(output, format='PNG', optimize=True)
+                normalised_type = 'image/png'
+            else:
+                image.convert('RGB').save(
+                    output, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True
+                )
+                normalised_type = 'image/jpeg'
+    except Exception as e:
+        logger.warning(f"Normalisation de l'image impossible: {e}")
+        return data, content_type
+
+    normalised = output.getvalue()
+    if not resized and len(normalised) >= len(data):
+        return data, content_type
+
+    _count('normalised_bytes_saved', len(data) - len(normalised))
+    return normalised, normalised_type
+
+
+def _normalise_data_uri(data_uri):
+    """Normalise une image fournie en URL data base64 (résultat mémorisé)"""
+    header, _, payload = data_uri.partition(',')
+    if not header.endswith(';base64') or 'svg' in header:
+        return data_uri
+
+    key = 'data:' + hashlib.sha256(data_uri.encode('utf-8')).hexdigest() + '|' + NORMALISATION_PROFILE
+    entry = memory_cache.get(key)
+    if entry is not None:
+        return entry['data_uri']
+
+    try:
+        data = base64.b64decode(payload)
+    except ValueError:
+        return data_uri
+    content_type = header[len('data:'):-len(';base64')]
+    data, content_type = normalise_image(data, content_type)
+    return _remember(key, {}, _to_data_uri(content_type, data))
+
+
+def _is_fresh(meta):
+    return time.time() - meta.get('fetched_at', 0) < IMAGE_CACHE_TTL
+
+
+def _remember(url, meta, data_uri):
+    memory_cache.set(url, {'meta': meta, 'data_uri': data_uri}, len(data_uri))
+    return data_uri
+
+
+def _lookup(cache_key):
+    """Consulte le cache; retourne (URL data si fraîche, entrée mémoire, métadonnées, contenu disque)"""
+    entry = memory_cache.get(cache_key)
+    if entry is not None and _is_fresh(entry['meta']):
+        _count('memory_hits')
+        return entry['data_uri'], entry, entry['meta'], None
+
+    if entry is not None:
+        return None, entry, entry['meta'], None
+
+    meta, data = disk_cache.get(cache_key)
+    if meta is not None and _is_fresh(meta):
+        _count('disk_hits')
+        return _remember(cache_key, meta, _to_data_uri(meta['content_type'], data)), None, meta, data
+    return None, None, meta, data
+
+
+def _conditional_headers(meta):
+    """En-têtes de revalidation d'une entrée expirée"""
+    headers = {}
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+
+def _store_response(cache_key, response, entry, meta, data):
+    """Exploite la réponse HTTP (requests ou httpx) : revalidation ou nouvelle image normalisée"""
+    if response.status_code == 304 and meta is not None:
+        meta = dict(meta, fetched_at=time.time())
+        disk_cache.set_meta(cache_key, meta)
+        _count('revalidated')
+        if entry is not None:
+            return _remember(cache_key, meta, entry['data_uri'])
+        return _remember(cache_key, meta, _to_data_uri(meta['content_type'], data))
+
+    response.raise_for_status()
+
+    content_type = response.headers.get('content-type', '')
+    if 'image' not in content_type:
+        logger.warning(f"URL ne semble pas être une image: {content_type}")
+        return None
+
+    data, content_type = normalise_image(response.content, content_type)
+    meta = disk_cache.set(cache_key, data, {
+        'content_type': content_type,
+        'etag': response.headers.get('etag'),
+        'last_modified': response.headers.get('last-modified'),
+        'fetched_at': time.time(),
+    })
+    _count('misses')
+    return _remember(cache_key, meta, _to_data_uri(content_type, data))
+
+
+def _fallback(error, entry, meta, data):
+    """Échec du téléchargement : sert la copie expirée si elle existe"""
+    _count('errors')
+    if entry is not None:
+        logger.warning(f"Image expirée servie depuis le cache ({error})")
+        return entry['data_uri']
+    if data is not None:
+        logger.warning(f"Image expirée servie depuis le cache ({error})")
+        return _to_data_uri(meta['content_type'], data)
+    logger.warning(f"Impossible de télécharger l'image: {error}")
+    return None
+
+
+def _fetch_remote_image(image_url):
+    """Retourne l'image distante normalisée en URL data en passant par le cache à deux niveaux"""
+    cache_key = image_url + '|' + NORMALISATION_PROFILE
+    data_uri, entry, meta, data = _lookup(cache_key)
+    if data_uri is not None:
+        return data_uri
+
+    # Entrée absente ou expirée : requête (conditionnelle si possible)
+    try:
+        response = http_session.get(
+            image_url, timeout=IMAGE_FETCH_TIMEOUT, headers=_conditional_headers(meta)
+        )
+        return _store_response(cache_key, response, entry, meta, data)
+    except Exception as e:
+        return _fallback(e, entry, meta, data)
+
+
+async def _fetch_remote_image_async(client, image_url):
+    """Variante non bloquante de `_fetch_remote_image` (client httpx asynchrone).
+
+    La normalisation Pillow, coûteuse en CPU, est exécutée hors de la boucle
+    d'événements.
+    """
+    cache_key = image_url + '|' + NORMALISATION_PROFILE
+    data_uri, entry, meta, data = _lookup(cache_key)
+    if data_uri is not None:
+        return data_uri
+
+    try:
+        response = await client.get(
+            image_url, timeout=IMAGE_FETCH_TIMEOUT, headers=_conditional_headers(meta)
+        )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, _store_response, cache_key, response, entry, meta, data
+        )
+    except Exception as e:
+        return _fallback(e, entry, meta, data)
+
+
+def process_image_url(image_url):
+    """Traite l'URL de l'image pour s'assurer qu'elle est accessible"""
+    if not image_url:
+        return None
+
+    try:
+        # Si c'est déjà une URL data, la normaliser
+        if image_url.startswith('data:'):
+            return _normalise_data_uri(image_url)
+
+        # Si c'est une URL HTTP/HTTPS, essayer de la télécharger
+        if image_url.startswith(('http://', 'https://')):
+            return _fetch_remote_image(image_url)
+
+        return None
+
+    except Exception as e:
+        logger.warning(f"Erreur traitement image URL: {e}")
+        return None
+
+
+def prefetch_images(image_urls):
+    """Télécharge en parallèle les URLs distinctes d'un lot.
+
+    Retourne un dictionnaire {url: url data ou None}; chaque image n'est
+    téléchargée et encodée qu'une seule fois, quel que soit le nombre de
+    billets qui la référencent.
+    """
+    distinct_urls = list(dict.fromkeys(url for url in image_urls if url))
+    if len(distinct_urls) <= 1:
+        return {url: process_image_url(url) for url in distinct_urls}
+
+    results = _get_executor().map(process_image_url, distinct_urls)
+    return dict(zip(distinct_urls, results))
+
+
+async def prefetch_images_async(client, image_urls):
+    """Télécharge de façon non bloquante les images distantes distinctes et remplit le cache"""
+    distinct_urls = list(dict.fromkeys(
+        url for url in image_urls if url and url.startswith(('http://', 'https://'))
+    ))
+    semaphore = asyncio.Semaphore(IMAGE_FETCH_WORKERS)
+
+    async def fetch(url):
+        async with semaphore:
+            return await _fetch_remote_image_async(client, url)
+
+    results = await asyncio.gather(*(fetch(url) for url in distinct_urls))
+    return dict(zip(distinct_urls, results))
@@ -0,0 +1,173 @@
+"""Lecture du corps des requêtes de rendu.
+
+Formats acceptés (`Content-Type`) :
+
+- `application/json` : un objet JSON, comme auparavant;
+- `application/x-ndjson` : un billet par ligne, lu ligne par ligne sans
+  charger le corps entier. Une première ligne `{"batch": {...}}` peut
+  porter les champs du lot (`event`, `design`, `output`, `stream`...);
+- `multipart/form-data` : le JSON (ou NDJSON) dans la partie `payload` et
+  les images en parties binaires. Un champ d'image (`event_image_url`,
+  `qr_code`) valant `"part:<nom>"` désigne la partie `<nom>` : l'image est
+  envoyée une fois, sans base64, quel que soit le nombre de billets qui
+  l'emploient. Les autres champs sont laissés tels quels.
+
+Le corps peut être compressé (`Content-Encoding: gzip` ou `zstd`, ce dernier
+si le paquet `zstandard` est installé); il est décompressé au fil de la
+lecture et borné à MAX_DECOMPRESSED_BYTES.
+"""
+import base64
+import gzip
+import io
+import json
+import os
+import zlib
+
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.formparser import FormDataParser
+
+try:
+    import zstandard
+except ImportError:  # zstd optionnel
+    zstandard = None
+
+# Taille maximale du corps une fois décompressé
+MAX_DECOMPRESSED_BYTES = int(os.environ.get('MAX_DECOMPRESSED_BYTES', 128 * 1024 * 1024))
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+PART_SCHEME = 'part:'
+# Seuls les champs d'image peuvent désigner une partie binaire
+PART_FIELDS = ('event_image_url', 'qr_code')
+READ_BLOCK_SIZE = 64 * 1024
+
+_DECOMPRESSION_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+class _LimitedReader(io.RawIOBase):
+    """Flux décompressé, interrompu (413) au-delà de `max_bytes`"""
+
+    def __init__(self, source, max_bytes):
+        self._source = source
+        self._max_bytes = max_bytes
+        self._remaining = max_bytes
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._source.read(min(len(buffer), READ_BLOCK_SIZE))
+        self._remaining -= len(data)
+        if self._remaining < 0:
+            raise RequestEntityTooLarge(f"Corps décompressé trop volumineux (maximum {self._max_bytes} octets)")
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def body_stream(request, max_bytes=MAX_DECOMPRESSED_BYTES):
+    """Flux du corps de la requête, décompressé à la lecture selon `Content-Encoding`"""
+    encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+    if encoding in ('', 'identity'):
+        return request.stream
+    if encoding in ('gzip', 'x-gzip'):
+        decompressed = gzip.GzipFile(fileobj=request.stream, mode='rb')
+    elif encoding == 'zstd':
+        if zstandard is None:
+            raise UnsupportedMediaType("Content-Encoding zstd indisponible (paquet zstandard non installé)")
+        decompressed = zstandard.ZstdDecompressor().stream_reader(request.stream, read_across_frames=True)
+    else:
+        raise UnsupportedMediaType(f"Content-Encoding non supporté: {encoding}")
+    return io.BufferedReader(_LimitedReader(decompressed, max_bytes), READ_BLOCK_SIZE)
+
+
+def parse_ndjson(stream, max_tickets):
+    """Lot NDJSON : en-tête `{"batch": {...}}` facultatif puis un billet par ligne"""
+    payload = {'tickets': []}
+    first = True
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Ligne {line_number}: JSON invalide ({e})")
+        if not isinstance(item, dict):
+            raise ValueError(f"Ligne {line_number}: objet JSON attendu")
+        if first and list(item) == ['batch']:
+            if not isinstance(item['batch'], dict):
+                raise ValueError("Ligne 1: le champ batch doit être un objet")
+            payload.update((key, value) for key, value in item['batch'].items() if key != 'tickets')
+        else:
+            payload['tickets'].append(item)
+            if len(payload['tickets']) > max_tickets:
+                raise ValueError(f'Maximum {max_tickets} billets par requête')
+        first = False
+    return payload
+
+
+def _parse_document(stream, mimetype, max_tickets):
+    if mimetype in NDJSON_MIMETYPES:
+        return parse_ndjson(stream, max_tickets)
+    try:
+        return json.load(stream)
+    except ValueError as e:
+        raise ValueError(f"Corps JSON invalide ({e})")
+
+
+def _part_data_uri(part):
+    if not part.mimetype.startswith('image/'):
+        raise ValueError(f"La partie {part.name} doit être une image (reçu {part.mimetype or 'type inconnu'})")
+    return f'data:{part.mimetype};base64,{base64.b64encode(part.stream.read()).decode("ascii")}'
+
+
+def _resolve_parts(payload, parts):
+    """Remplace les références `part:<nom>` des champs d'image par l'image de la partie (une data URI par partie)"""
+    data_uris = {}
+    records = [payload.get('ticket'), payload.get('event')]
+    if isinstance(payload.get('tickets'), list):
+        records.extend(payload['tickets'])
+    for record in records:
+        if not isinstance(record, dict):
+            continue
+        for field in PART_FIELDS:
+            value = record.get(field)
+            if not isinstance(value, str) or not value.startswith(PART_SCHEME):
+                continue
+            name = value[len(PART_SCHEME):]
+            if name not in data_uris:
+                if name not in parts:
+                    raise ValueError(f"Partie introuvable: {name} (champ {field})")
+                data_uris[name] = _part_data_uri(parts[name])
+            record[field] = data_uris[name]
+
+
+def parse_multipart(stream, mimetype, options, max_tickets, max_bytes=MAX_DECOMPRESSED_BYTES):
+    """Lot multipart : partie `payload` (JSON ou NDJSON) et images en parties binaires"""
+    parser = FormDataParser(max_form_memory_size=max_bytes, silent=False)
+    _, form, files = parser.parse(stream, mimetype, None, options)
+    if 'payload' in files:
+        payload_part = files['payload']
+        payload = _parse_document(payload_part.stream, payload_part.mimetype, max_tickets)
+    elif 'payload' in form:
+        payload = _parse_document(io.BytesIO(form['payload'].encode('utf-8')), 'application/json', max_tickets)
+    else:
+        raise ValueError("Partie payload requise (JSON du billet ou du lot)")
+    if isinstance(payload, dict):
+        _resolve_parts(payload, {name: part for name, part in files.items() if name != 'payload'})
+    return payload
+
+
+def read_payload(request, max_tickets):
+    """Décode le corps d'une requête de rendu; lève ValueError si le corps est invalide"""
+    stream = body_stream(request)
+    try:
+        if request.mimetype == 'multipart/form-data':
+            return parse_multipart(stream, request.mimetype, request.mimetype_params, max_tickets)
+        if request.mimetype in NDJSON_MIMETYPES or request.is_json:
+            return _parse_document(stream, request.mimetype, max_tickets)
+    except _DECOMPRESSION_ERRORS as e:
+        raise ValueError(f"Corps compressé invalide: {e}")
+    raise UnsupportedMediaType(
+        f"Content-Type non supporté: {request.mimetype or 'absent'} "
+        f"(application/json, application/x-ndjson ou multipart/form-data)"
+    )
@@ -0,0 +1,343 @@
+"""Traitement asynchrone des gros lots de billets.
+
+Une tâche est mise en file par `POST /jobs`, exécutée par un pool de threads
+local au worker, et son PDF est écrit sur disque (JOBS_DIR). La file passe
+par un broker interchangeable :
+
+- `SqliteBroker` (par défaut) : partagé entre les workers gunicorn, les
+  tâches et leur état survivent au redémarrage d'un worker;
+- `InProcessBroker` : file en mémoire, propre à un seul processus.
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+JOBS_DIR = os.environ.get(
+    'JOBS_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'jobs')
+)
+JOB_BROKER = os.environ.get('JOB_BROKER', 'sqlite').lower()
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# Durée de conservation des tâches terminées et de leur PDF
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 24 * 3600))
+# Une tâche en cours dont le worker n'a plus signalé d'activité depuis ce délai est remise en file
+JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', 600))
+# Intervalle des signaux d'activité des tâches en cours (heartbeat)
+JOB_HEARTBEAT_INTERVAL = int(os.environ.get('JOB_HEARTBEAT_INTERVAL', 30))
+
+JOB_FIELDS = ('id', 'status', 'progress', 'total', 'error', 'created_at', 'updated_at')
+
+
+class InProcessBroker:
+    """File de tâches en mémoire (un seul processus)"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, job_id, payload, total):
+        now = time.time()
+        with self._lock:
+            self._jobs[job_id] = {
+                'id': job_id, 'status': 'queued', 'progress': 0, 'total': total,
+                'error': None, 'created_at': now, 'updated_at': now,
+            }
+        self._queue.put((job_id, payload))
+
+    def claim(self, owner, timeout=1.0):
+        try:
+            job_id, payload = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self.update(job_id, status='running')
+        return job_id, payload
+
+    def heartbeat(self, owner, job_ids):
+        # Une tâche en mémoire disparaît avec son processus : jamais remise en file
+        pass
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields, updated_at=time.time())
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def purge(self, older_than):
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job['status'] in ('done', 'failed') and job['updated_at'] < older_than
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+        return expired
+
+
+class SqliteBroker:
+    """File de tâches SQLite partagée entre les processus.
+
+    Une tâche en cours appartient au processus qui l'a prise (`owner`), qui
+    signale régulièrement son activité (`heartbeat_at`). Elle n'est remise
+    en file que si ce signal cesse (processus arrêté ou recyclé), jamais
+    pendant qu'elle s'exécute encore.
+    """
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    payload TEXT,
+                    progress INTEGER NOT NULL DEFAULT 0,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    owner TEXT,
+                    heartbeat_at REAL
+                )
+            """)
+            # Bases créées avant le suivi des propriétaires
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(jobs)")}
+            for column, column_type in (('owner', 'TEXT'), ('heartbeat_at', 'REAL')):
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)"
+            )
+
+    def _connect(self):
+        """Une connexion par thread (les connexions sqlite3 ne se partagent pas)"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def enqueue(self, job_id, payload, total):
+        now = time.time()
+        self._connect().execute(
+            "INSERT INTO jobs (id, status, payload, total, created_at, updated_at) "
+            "VALUES (?, 'queued', ?, ?, ?, ?)",
+            (job_id, json.dumps(payload), total, now, now)
+        )
+
+    def claim(self, owner, timeout=1.0):
+        deadline = time.monotonic() + timeout
+        connection = self._connect()
+        while True:
+            now = time.time()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute(
+                    "SELECT id, payload FROM jobs "
+                    "WHERE status = 'queued' "
+                    "OR (status = 'running' AND COALESCE(heartbeat_at, updated_at) < ?) "
+                    "ORDER BY created_at LIMIT 1",
+                    (now - JOB_STALE_AFTER,)
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE jobs SET status = 'running', owner = ?, heartbeat_at = ?, updated_at = ? "
+                        "WHERE id = ?",
+                        (owner, now, now, row[0])
+                    )
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            if row is not None:
+                return row[0], json.loads(row[1])
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(self.POLL_INTERVAL)
+
+    def heartbeat(self, owner, job_ids):
+        """Signale que les tâches `job_ids` de ce propriétaire s'exécutent encore"""
+        self._connect().executemany(
+            "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND owner = ? AND status = 'running'",
+            [(time.time(), job_id, owner) for job_id in job_ids]
+        )
+
+    def update(self, job_id, **fields):
+        if fields.get('status') in ('done', 'failed'):
+            # La charge utile n'est plus utile une fois la tâche terminée
+            fields['payload'] = None
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self._connect().execute(
+            f"UPDATE jobs SET {assignments} WHERE id = ?",
+            (*fields.values(), job_id)
+        )
+
+    def get(self, job_id):
+        row = self._connect().execute(
+            f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        return dict(zip(JOB_FIELDS, row)) if row is not None else None
+
+    def purge(self, older_than):
+        connection = self._connect()
+        expired = [row[0] for row in connection.execute(
+            "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+            (older_than,)
+        )]
+        connection.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in expired])
+        return expired
+
+
+def create_broker(name=JOB_BROKER):
+    if name == 'memory':
+        return InProcessBroker()
+    if name == 'sqlite':
+        return SqliteBroker(os.path.join(JOBS_DIR, 'jobs.sqlite3'))
+    raise ValueError(f"Broker de tâches inconnu: {name}")
+
+
+class JobManager:
+    """Exécute les tâches de la file sur un pool de threads local au worker.
+
+    `render` reçoit (charge utile, chemin du PDF à écrire, fonction de
+    progression) et écrit le résultat sur disque. Chaque exécution écrit
+    son propre fichier temporaire, renommé atomiquement une fois complet.
+    """
+
+    PURGE_INTERVAL = 300
+
+    def __init__(self, broker, render, workers=JOB_WORKERS, results_dir=JOBS_DIR):
+        self.broker = broker
+        self.render = render
+        self.workers = workers
+        self.results_dir = results_dir
+        self._threads_pid = None
+        self._last_purge = 0.0
+        self._lock = threading.Lock()
+        # Tâches en cours dans ce processus, signalées par le thread de heartbeat
+        self._running = set()
+        self._running_lock = threading.Lock()
+
+    @property
+    def owner(self):
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def ensure_started(self):
+        """Démarre les threads d'exécution (une fois par processus, après un fork)"""
+        if self._threads_pid == os.getpid():
+            return
+        with self._lock:
+            if self._threads_pid == os.getpid():
+                return
+            os.makedirs(self.results_dir, exist_ok=True)
+            with self._running_lock:
+                # Tâches héritées du processus parent : elles ne s'exécutent pas ici
+                self._running.clear()
+            for index in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name=f'job-worker-{index}', daemon=True
+                )
+                thread.start()
+            threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True).start()
+            self._threads_pid = os.getpid()
+
+    def submit(self, payload, total):
+        job_id = uuid.uuid4().hex
+        self.broker.enqueue(job_id, payload, total)
+        self.ensure_started()
+        return job_id
+
+    def get(self, job_id):
+        return self.broker.get(job_id)
+
+    def result_path(self, job_id):
+        return os.path.join(self.results_dir, f'{job_id}.pdf')
+
+    def _run(self):
+        while True:
+            try:
+                self._purge_expired()
+                claimed = self.broker.claim(self.owner)
+            except Exception as e:
+                logger.error(f"Erreur de la file de tâches: {str(e)}", exc_info=True)
+                time.sleep(1)
+                continue
+            if claimed is None:
+                continue
+            job_id, payload = claimed
+            self._execute(job_id, payload)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(JOB_HEARTBEAT_INTERVAL)
+            with self._running_lock:
+                job_ids = list(self._running)
+            if not job_ids:
+                continue
+            try:
+                self.broker.heartbeat(self.owner, job_ids)
+            except Exception as e:
+                logger.error(f"Erreur de la file de tâches: {str(e)}", exc_info=True)
+
+    def _execute(self, job_id, payload):
+        result_path = self.result_path(job_id)
+        # Propre à l'exécution : une tâche remise en file n'écrit jamais dans le fichier d'une autre
+        tmp_path = f'{result_path}.{uuid.uuid4().hex[:12]}.part'
+
+        def report_progress(progress):
+            self.broker.update(job_id, progress=progress)
+
+        with self._running_lock:
+            self._running.add(job_id)
+        try:
+            self.render(payload, tmp_path, report_progress)
+            os.replace(tmp_path, result_path)
+            self.broker.update(job_id, status='done')
+            logger.info(f"Tâche {job_id} terminée")
+        except Exception as e:
+            logger.error(f"Tâche {job_id} en échec: {str(e)}", exc_info=True)
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            self.broker.update(job_id, status='failed', error=str(e))
+        finally:
+            with self._running_lock:
+                self._running.discard(job_id)
+
+    def _purge_expired(self):
+        now = time.time()
+        if now - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        for job_id in self.broker.purge(now - JOB_RETENTION):
+            try:
+                os.unlink(self.result_path(job_id))
+            except OSError:
+                pass
+        # Fichiers temporaires laissés par un processus arrêté en cours de tâche
+        for name in os.listdir(self.results_dir):
+            path = os.path.join(self.results_dir, name)
+            try:
+                if name.endswith('.part') and os.path.getmtime(path) < now - JOB_RETENTION:
+                    os.unlink(path)
+            except OSError:
+                pass
@@ -0,0 +1,336 @@
+"""Instrumentation : durée par étape de rendu et métriques au format Prometheus.
+
+Les métriques sont tenues en mémoire par processus. Avec METRICS_DIR
+(défini par `gunicorn.conf.py`), chaque worker y écrit périodiquement ses
+valeurs (`<pid>.prom`) et `/metrics` additionne celles de tous les workers :
+quel que soit le worker interrogé, les compteurs sont ceux du service et ne
+reculent pas. Les valeurs d'un worker arrêté (recyclage) sont reportées dans
+`archive.prom`. Sans METRICS_DIR, `/metrics` expose le seul processus courant.
+
+Les étapes chronométrées pendant une requête sont aussi gardées dans
+`flask.g` pour l'en-tête `Server-Timing`.
+"""
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+try:
+    import fcntl
+except ImportError:  # Windows : pas d'archivage des workers arrêtés
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Répertoire partagé par les workers (vide : métriques du seul processus courant)
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+# Intervalle d'écriture des valeurs de chaque worker, en secondes
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+ARCHIVE_FILE = 'archive.prom'
+
+# Bornes des histogrammes de durée, en secondes
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = ','.join(
+        f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)
+    )
+    return '{' + pairs + '}'
+
+
+class Counter:
+    """Compteur monotone, éventuellement étiqueté"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Histogram:
+    """Histogramme cumulatif à bornes fixes, éventuellement étiqueté"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            series['counts'][index] += 1
+            series['sum'] += value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), series['counts']):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    labels = _format_labels(self.labelnames + ('le',), key + (le,))
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f'{self.name}_sum{labels} {series["sum"]}')
+                lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """`collector()` retourne des lignes au format texte, calculées à la lecture"""
+        self._collectors.append(collector)
+
+    def expose(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+STAGE_DURATION = registry.register(Histogram(
+    'pdf_service_stage_duration_seconds',
+    'Durée de chaque étape du traitement des billets',
+    labelnames=('stage',)
+))
+REQUEST_DURATION = registry.register(Histogram(
+    'pdf_service_request_duration_seconds',
+    'Durée totale des requêtes par route',
+    labelnames=('endpoint', 'status')
+))
+TICKETS_GENERATED = registry.register(Counter(
+    'pdf_service_tickets_generated_total',
+    'Nombre de billets générés',
+    labelnames=('endpoint',)
+))
+ADMISSION_REJECTED = registry.register(Counter(
+    'pdf_service_admission_rejected_total',
+    'Requêtes refusées par le contrôle d\'admission',
+    labelnames=('endpoint', 'status')
+))
+BYTES_SENT = registry.register(Counter(
+    'pdf_service_response_bytes_total',
+    'Octets envoyés dans les réponses',
+    labelnames=('endpoint',)
+))
+
+
+def counter_lines(name, documentation, values, label):
+    """Lignes de compteur Prometheus à partir d'un dictionnaire {étiquette: valeur}"""
+    lines = [f'# HELP {name} {documentation}', f'# TYPE {name} counter']
+    for key, value in sorted(values.items()):
+        lines.append(f'{name}{{{label}="{key}"}} {value}')
+    return lines
+
+
+def _write_atomic(path, text):
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w', encoding='utf-8') as output:
+        output.write(text)
+    os.replace(temporary, path)
+
+
+def flush(directory=METRICS_DIR):
+    """Écrit les valeurs du processus courant dans `<pid>.prom`"""
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    _write_atomic(os.path.join(directory, f'{os.getpid()}.prom'), registry.expose())
+
+
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def _flush_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush()
+        except OSError as e:
+            logger.warning(f"Écriture des métriques impossible: {e}")
+
+
+def start_flusher(interval=METRICS_FLUSH_INTERVAL):
+    """Démarre l'écriture périodique des valeurs du worker (une fois par processus)"""
+    global _flusher_pid
+    if not METRICS_DIR:
+        return
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_loop, args=(interval,), daemon=True, name='metrics-flush').start()
+
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def _parse(text):
+    """Familles d'une exposition texte : {nom: {'headers', 'type', 'samples'}}, dans l'ordre du texte"""
+    families = {}
+    family = None
+    for line in text.splitlines():
+        if not line:
+            continue
+        if line.startswith('# '):
+            parts = line.split(' ', 3)
+            family = families.setdefault(parts[2], {'headers': [], 'type': 'untyped', 'samples': {}})
+            family['headers'].append(line)
+            if parts[1] == 'TYPE':
+                family['type'] = parts[3]
+            continue
+        sample, value = line.rsplit(' ', 1)
+        if family is None:
+            family = families.setdefault(sample.split('{', 1)[0], {'headers': [], 'type': 'untyped', 'samples': {}})
+        family['samples'][sample] = family['samples'].get(sample, 0) + _number(value)
+    return families
+
+
+def _merge(target, families, include_gauges=True):
+    """Additionne les échantillons de `families` à ceux de `target` (même nom et mêmes étiquettes)"""
+    for name, family in families.items():
+        if family['type'] == 'gauge' and not include_gauges:
+            continue
+        merged = target.setdefault(name, {'headers': family['headers'], 'type': family['type'], 'samples': {}})
+        for sample, value in family['samples'].items():
+            merged['samples'][sample] = merged['samples'].get(sample, 0) + value
+
+
+def _format(families):
+    lines = []
+    for family in families.values():
+        lines.extend(family['headers'])
+        lines.extend(f'{sample} {value}' for sample, value in family['samples'].items())
+    return '\n'.join(lines) + '\n'
+
+
+def _read(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as source:
+            return _parse(source.read())
+    except FileNotFoundError:
+        return {}
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _archive_dead_workers(directory):
+    """Reporte dans l'archive les compteurs et histogrammes des workers arrêtés (les jauges sont ignorées)"""
+    dead = [
+        entry for entry in os.listdir(directory)
+        if entry.endswith('.prom') and entry[:-len('.prom')].isdigit() and not _alive(int(entry[:-len('.prom')]))
+    ]
+    if not dead:
+        return
+    archive_path = os.path.join(directory, ARCHIVE_FILE)
+    archive = _read(archive_path)
+    for entry in dead:
+        _merge(archive, _read(os.path.join(directory, entry)), include_gauges=False)
+    _write_atomic(archive_path, _format(archive))
+    for entry in dead:
+        os.remove(os.path.join(directory, entry))
+
+
+def collect(directory=METRICS_DIR):
+    """Exposition des métriques : somme de tous les workers si METRICS_DIR est défini"""
+    if not directory:
+        return registry.expose()
+    flush(directory)
+    lock_file = open(os.path.join(directory, 'archive.lock'), 'a+b')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            _archive_dead_workers(directory)
+        merged = {}
+        for entry in sorted(os.listdir(directory)):
+            if entry.endswith('.prom'):
+                _merge(merged, _read(os.path.join(directory, entry)))
+    finally:
+        lock_file.close()
+    return _format(merged)
+
+
+def reset(directory=METRICS_DIR):
+    """Efface les valeurs d'une exécution précédente (au démarrage du serveur)"""
+    if not directory or not os.path.isdir(directory):
+        return
+    for entry in os.listdir(directory):
+        if entry.endswith(('.prom', '.tmp')):
+            os.remove(os.path.join(directory, entry))
+
+
+@contextmanager
+def stage(name):
+    """Chronomètre une étape; la durée alimente l'histogramme et `Server-Timing`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, stage=name)
+        if has_request_context():
+            timings = g.setdefault('stage_timings', [])
+            timings.append((name, elapsed))
+
+
+def server_timing_header(timings):
+    """Valeur de l'en-tête `Server-Timing` (durées en millisecondes)"""
+    return ', '.join(f'{name};dur={elapsed * 1000:.1f}' for name, elapsed in timings)
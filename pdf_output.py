@@ -0,0 +1,120 @@
+"""Profil d'écriture des PDF.
+
+- flux d'objets compressés : les dictionnaires (pages, polices, annotations)
+  sont regroupés dans un flux compressé et la table xref devient un flux
+  (PDF 1.5+). WeasyPrint 58 ne le demande pas à pydyf, le document est donc
+  écrit ici plutôt que par `Document.write_pdf`;
+- optimisation des images (`'images'` dans `optimize_size`) : encodage JPEG
+  et PNG optimisé des images intégrées. Leur résolution et leur qualité sont
+  déjà bornées en amont (voir `images.normalise_image`);
+- cache des sous-ensembles de polices : WeasyPrint sous-ensemble chaque
+  police embarquée à chaque document (fontTools). Le résultat est gardé en
+  mémoire, indexé par fichier de police et jeu de glyphes, et réutilisé par
+  les documents suivants qui emploient les mêmes glyphes.
+
+Les flux d'objets et le cache des polices passent par des API internes de
+WeasyPrint (`weasyprint.pdf.generate_pdf`, `Font.clean`). Elles ne sont
+employées qu'avec une version vérifiée (SUPPORTED_WEASYPRINT_VERSIONS);
+avec toute autre version, le document est écrit par `Document.write_pdf`
+et les polices sont sous-ensemblées sans cache.
+"""
+import hashlib
+import io
+import logging
+import os
+import threading
+
+import weasyprint
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Versions de WeasyPrint dont les API internes employées ici ont été vérifiées (voir requirements.txt)
+SUPPORTED_WEASYPRINT_VERSIONS = ('58.1',)
+WEASYPRINT_INTERNALS = weasyprint.__version__ in SUPPORTED_WEASYPRINT_VERSIONS
+
+if WEASYPRINT_INTERNALS:
+    from weasyprint.pdf import generate_pdf
+    from weasyprint.pdf.stream import Font
+else:
+    generate_pdf = Font = None
+    logger.warning(
+        f"WeasyPrint {weasyprint.__version__} non vérifié (attendu: {', '.join(SUPPORTED_WEASYPRINT_VERSIONS)}) : "
+        f"PDF écrits par Document.write_pdf, sans flux d'objets ni cache des polices"
+    )
+
+PDF_COMPRESS_OBJECTS = os.environ.get('PDF_COMPRESS_OBJECTS', 'true').lower() == 'true'
+PDF_OPTIMIZE_IMAGES = os.environ.get('PDF_OPTIMIZE_IMAGES', 'true').lower() == 'true'
+FONT_SUBSET_CACHE_BYTES = int(os.environ.get('FONT_SUBSET_CACHE_BYTES', 32 * 1024 * 1024))
+
+# Options de mise en page passées à `HTML.render`
+OPTIMIZE_SIZE = ('fonts', 'images') if PDF_OPTIMIZE_IMAGES else ('fonts',)
+
+_subsets = LRUCache(FONT_SUBSET_CACHE_BYTES)
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+_original_clean = Font.clean if WEASYPRINT_INTERNALS else None
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def font_subset_stats():
+    """Compteurs du cache des sous-ensembles de polices (propres au worker courant)"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['entries'] = len(_subsets)
+    stats['bytes'] = _subsets.current_bytes
+    return stats
+
+
+def _subset_key(font, cmap):
+    digest = hashlib.sha256(font.file_content)
+    digest.update(str(font.index).encode())
+    # Une police variable est figée selon la graisse, le style et la taille demandés
+    if 'fvar' in font.ttfont:
+        digest.update(font.name)
+    digest.update(','.join(map(str, sorted(cmap))).encode())
+    return digest.hexdigest()
+
+
+def _cached_clean(font, cmap):
+    """`Font.clean` avec cache : le sous-ensemble n'est calculé qu'une fois par jeu de glyphes"""
+    if font.ttfont is None or not cmap:
+        return _original_clean(font, cmap)
+    key = _subset_key(font, cmap)
+    file_content = _subsets.get(key)
+    if file_content is not None:
+        _count('hits')
+        font.file_content = file_content
+        return None
+    _count('misses')
+    _original_clean(font, cmap)
+    _subsets.set(key, font.file_content, len(font.file_content))
+    return None
+
+
+def install_font_subset_cache():
+    """Remplace `Font.clean` de WeasyPrint par sa version avec cache (0 désactive le cache)"""
+    if WEASYPRINT_INTERNALS and FONT_SUBSET_CACHE_BYTES > 0 and Font.clean is _original_clean:
+        Font.clean = _cached_clean
+
+
+def write_document(document, target=None):
+    """Écrit un document mis en page dans `target` (ou retourne les octets)"""
+    if not PDF_COMPRESS_OBJECTS or not WEASYPRINT_INTERNALS:
+        return document.write_pdf(target)
+    pdf = generate_pdf(document, target, 1, None, OPTIMIZE_SIZE, None, None, None, False)
+    if target is None:
+        output = io.BytesIO()
+        pdf.write(output, version=pdf.version, compress=True)
+        return output.getvalue()
+    if hasattr(target, 'write'):
+        pdf.write(target, version=pdf.version, compress=True)
+    else:
+        with open(target, 'wb') as target_file:
+            pdf.write(target_file, version=pdf.version, compress=True)
+    return None
@@ -0,0 +1,294 @@
+"""Assemblage incrémental de PDF.
+
+`StreamingPdfWriter` concatène des PDF (un par lot de billets) en écrivant
+leurs objets au fur et à mesure : seuls les offsets des objets et la liste
+des pages sont gardés en mémoire jusqu'à l'écriture finale de l'arbre des
+pages, de la table xref et du trailer. La mémoire reste donc bornée par la
+taille d'un lot, quel que soit le nombre total de billets.
+
+`IncrementalPdfWriter` ajoute de la même façon des pages à un PDF existant,
+par mise à jour incrémentale : le PDF d'origine est recopié tel quel et
+suivi des nouveaux objets, de l'arbre des pages mis à jour et d'une section
+xref chaînée à la précédente (`/Prev`).
+"""
+import copy
+import io
+import re
+import shutil
+
+from pypdf import PdfReader
+from pypdf.errors import PdfReadError
+from pypdf.generic import (
+    ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject, NameObject, NumberObject
+)
+
+from cache import COPY_BLOCK_SIZE
+
+PDF_HEADER = b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n'
+
+
+class StreamingPdfWriter:
+    """Écrit un PDF unique à partir de PDF ajoutés successivement"""
+
+    def __init__(self):
+        self._buffer = io.BytesIO()
+        self._position = 0
+        self._offsets = {}
+        self._next_id = 1
+        self._page_ids = []
+        self._pages_id = self._allocate()
+        self._catalog_id = self._allocate()
+        self._write(PDF_HEADER)
+
+    def _allocate(self):
+        object_id = self._next_id
+        self._next_id += 1
+        return object_id
+
+    def _write(self, data):
+        self._buffer.write(data)
+        self._position += len(data)
+
+    def _write_object(self, object_id, obj):
+        self._offsets[object_id] = self._position
+        self._write(f'{object_id} 0 obj\n'.encode())
+        stream = io.BytesIO()
+        obj.write_to_stream(stream)
+        self._write(stream.getvalue())
+        self._write(b'\nendobj\n')
+
+    def _remap(self, obj, mapping, pending):
+        """Copie un objet en renumérotant ses références indirectes"""
+        if isinstance(obj, IndirectObject):
+            if obj.idnum not in mapping:
+                mapping[obj.idnum] = self._allocate()
+                pending.append(obj)
+            return IndirectObject(mapping[obj.idnum], 0, None)
+        if isinstance(obj, DictionaryObject):
+            # Copie superficielle : conserve les données encodées des flux
+            remapped = copy.copy(obj)
+            for key, value in obj.items():
+                remapped[key] = self._remap(value, mapping, pending)
+            return remapped
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._remap(value, mapping, pending) for value in obj)
+        return obj
+
+    def append(self, pdf_bytes):
+        """Ajoute toutes les pages d'un PDF et écrit immédiatement leurs objets"""
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        mapping = {}
+        pending = []
+        page_ids = set()
+
+        # Les pages sont numérotées d'abord : les liens internes s'y résolvent
+        for page in reader.pages:
+            page_ref = page.indirect_reference
+            self._remap(page_ref, mapping, pending)
+            page_ids.add(page_ref.idnum)
+            self._page_ids.append(mapping[page_ref.idnum])
+
+        while pending:
+            reference = pending.pop()
+            obj = reference.get_object()
+            if reference.idnum in page_ids:
+                obj = DictionaryObject(
+                    (key, value) for key, value in obj.items() if key != '/Parent'
+                )
+            remapped = self._remap(obj, mapping, pending)
+            if reference.idnum in page_ids:
+                remapped[NameObject('/Parent')] = IndirectObject(self._pages_id, 0, None)
+            self._write_object(mapping[reference.idnum], remapped)
+
+    @property
+    def page_count(self):
+        return len(self._page_ids)
+
+    def close(self):
+        """Écrit l'arbre des pages, le catalogue, la table xref et le trailer"""
+        kids = ' '.join(f'{page_id} 0 R' for page_id in self._page_ids)
+        self._offsets[self._pages_id] = self._position
+        self._write(
+            f'{self._pages_id} 0 obj\n<< /Type /Pages /Kids [{kids}] '
+            f'/Count {len(self._page_ids)} >>\nendobj\n'.encode()
+        )
+        self._offsets[self._catalog_id] = self._position
+        self._write(
+            f'{self._catalog_id} 0 obj\n<< /Type /Catalog /Pages {self._pages_id} 0 R >>'
+            f'\nendobj\n'.encode()
+        )
+
+        xref_position = self._position
+        size = self._next_id
+        lines = [f'xref\n0 {size}\n', '0000000000 65535 f \n']
+        for object_id in range(1, size):
+            lines.append(f'{self._offsets[object_id]:010d} 00000 n \n')
+        self._write(''.join(lines).encode())
+        self._write(
+            f'trailer\n<< /Size {size} /Root {self._catalog_id} 0 R >>\n'
+            f'startxref\n{xref_position}\n%%EOF\n'.encode()
+        )
+
+    def drain(self):
+        """Retourne les octets écrits depuis le dernier appel et libère le tampon"""
+        data = self._buffer.getvalue()
+        self._buffer = io.BytesIO()
+        return data
+
+
+STARTXREF_RE = re.compile(rb'startxref\s+(\d+)')
+
+
+def _startxref(pdf_file):
+    """Position de la dernière section xref, lue à la fin du fichier"""
+    size = pdf_file.seek(0, io.SEEK_END)
+    pdf_file.seek(max(0, size - 1024))
+    matches = STARTXREF_RE.findall(pdf_file.read())
+    if not matches:
+        raise ValueError("PDF invalide : startxref introuvable")
+    return int(matches[-1])
+
+
+class IncrementalPdfWriter(StreamingPdfWriter):
+    """Écrit une mise à jour incrémentale ajoutant des pages à un PDF existant.
+
+    Seuls les octets ajoutés passent par le tampon (`drain`); le PDF
+    d'origine est à recopier avant eux, sans modification.
+    """
+
+    def __init__(self, base_file):
+        try:
+            reader = PdfReader(base_file)
+            if reader.is_encrypted:
+                raise ValueError("PDF chiffré non supporté")
+            trailer = reader.trailer
+            pages_ref = trailer['/Root'].raw_get('/Pages')
+            if not isinstance(pages_ref, IndirectObject) or pages_ref.generation != 0:
+                raise ValueError("PDF non supporté : arbre des pages inattendu")
+            pages = pages_ref.get_object()
+            # Copie superficielle : les références vers les objets d'origine restent valides
+            self._base_pages = DictionaryObject(pages)
+            self._base_kids = list(pages['/Kids'])
+            self._base_count = int(pages['/Count'])
+        except (PdfReadError, KeyError, TypeError) as e:
+            raise ValueError(f"PDF illisible: {e}")
+        self._trailer_refs = {
+            key: trailer.raw_get(key) for key in ('/Root', '/Info', '/ID') if key in trailer
+        }
+        self._prev = _startxref(base_file)
+        base_file.seek(self._prev)
+        # Une section xref « table » commence par `xref`, sinon c'est un flux (PDF 1.5+)
+        self._xref_stream = base_file.read(4) != b'xref'
+        size = base_file.seek(0, io.SEEK_END)
+        base_file.seek(-1, io.SEEK_END)
+        ends_with_newline = base_file.read(1) in (b'\n', b'\r')
+
+        self._buffer = io.BytesIO()
+        self._position = size
+        self._offsets = {}
+        self._next_id = int(trailer['/Size'])
+        self._page_ids = []
+        self._pages_id = pages_ref.idnum
+        if not ends_with_newline:
+            self._write(b'\n')
+
+    @property
+    def base_page_count(self):
+        """Nombre de pages du PDF d'origine"""
+        return self._base_count
+
+    def close(self):
+        """Écrit l'arbre des pages mis à jour puis la section xref et le trailer de la mise à jour"""
+        pages = DictionaryObject(self._base_pages)
+        pages[NameObject('/Kids')] = ArrayObject(
+            self._base_kids + [IndirectObject(page_id, 0, None) for page_id in self._page_ids]
+        )
+        pages[NameObject('/Count')] = NumberObject(self._base_count + len(self._page_ids))
+        self._write_object(self._pages_id, pages)
+        if self._xref_stream:
+            self._write_xref_stream()
+        else:
+            self._write_xref_table()
+
+    def _xref_sections(self):
+        """Sous-sections xref : (premier identifiant, offsets des identifiants consécutifs)"""
+        sections = []
+        for object_id in sorted(self._offsets):
+            if sections and sections[-1][0] + len(sections[-1][1]) == object_id:
+                sections[-1][1].append(self._offsets[object_id])
+            else:
+                sections.append((object_id, [self._offsets[object_id]]))
+        return sections
+
+    def _trailer(self):
+        trailer = DictionaryObject({
+            NameObject('/Size'): NumberObject(self._next_id),
+            NameObject('/Prev'): NumberObject(self._prev),
+        })
+        for key, value in self._trailer_refs.items():
+            trailer[NameObject(key)] = value
+        return trailer
+
+    def _write_xref_table(self):
+        xref_position = self._position
+        # L'entrée libre de l'objet 0 est répétée : certains lecteurs attendent une table qui commence à 0
+        lines = ['xref\n0 1\n0000000000 65535 f \n']
+        for first_id, offsets in self._xref_sections():
+            lines.append(f'{first_id} {len(offsets)}\n')
+            lines.extend(f'{offset:010d} 00000 n \n' for offset in offsets)
+        self._write(''.join(lines).encode())
+        trailer = io.BytesIO()
+        self._trailer().write_to_stream(trailer)
+        self._write(
+            b'trailer\n' + trailer.getvalue() + f'\nstartxref\n{xref_position}\n%%EOF\n'.encode()
+        )
+
+    def _write_xref_stream(self):
+        # Le flux xref est lui-même un objet de la mise à jour
+        xref_id = self._allocate()
+        xref_position = self._position
+        self._offsets[xref_id] = xref_position
+        width = max(1, (xref_position.bit_length() + 7) // 8)
+        index = ArrayObject()
+        entries = []
+        for first_id, offsets in self._xref_sections():
+            index.extend((NumberObject(first_id), NumberObject(len(offsets))))
+            entries.extend(b'\x01' + offset.to_bytes(width, 'big') + b'\x00' for offset in offsets)
+        xref = DecodedStreamObject()
+        xref.update(self._trailer())
+        xref.update({
+            NameObject('/Type'): NameObject('/XRef'),
+            NameObject('/Index'): index,
+            NameObject('/W'): ArrayObject([NumberObject(1), NumberObject(width), NumberObject(1)]),
+        })
+        xref.set_data(b''.join(entries))
+        self._write_object(xref_id, xref)
+        self._write(f'startxref\n{xref_position}\n%%EOF\n'.encode())
+
+
+def append_to_pdf(base_file, pdf_chunks, target, writer=None):
+    """Recopie `base_file` dans `target` puis y ajoute les pages des PDF successifs.
+
+    `writer` est l'IncrementalPdfWriter déjà construit sur `base_file`, le cas
+    échéant. Retourne le nombre de pages ajoutées.
+    """
+    if writer is None:
+        writer = IncrementalPdfWriter(base_file)
+    base_file.seek(0)
+    shutil.copyfileobj(base_file, target, COPY_BLOCK_SIZE)
+    for pdf_bytes in pdf_chunks:
+        writer.append(pdf_bytes)
+        target.write(writer.drain())
+    writer.close()
+    target.write(writer.drain())
+    return writer.page_count
+
+
+def stream_merged_pdf(pdf_chunks):
+    """Générateur : fusionne des PDF successifs en un seul, bloc par bloc"""
+    writer = StreamingPdfWriter()
+    for pdf_bytes in pdf_chunks:
+        writer.append(pdf_bytes)
+        yield writer.drain()
+    writer.close()
+    yield writer.drain()
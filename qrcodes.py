@@ -0,0 +1,39 @@
+"""Génération locale des QR codes de validation (sans appel à une API externe)."""
+import base64
+import io
+import os
+from functools import lru_cache
+
+import qrcode
+import qrcode.image.svg
+from qrcode.image.pil import PilImage
+
+# svg (vectoriel, net à toute échelle) ou png
+QR_CODE_FORMAT = os.environ.get('QR_CODE_FORMAT', 'svg').lower()
+QR_CODE_CACHE_SIZE = int(os.environ.get('QR_CODE_CACHE_SIZE', 4096))
+
+# Taille d'un module en pixels pour la sortie PNG (le conteneur fait 60px)
+PNG_BOX_SIZE = 4
+
+
+@lru_cache(maxsize=QR_CODE_CACHE_SIZE)
+def qr_code_data_uri(payload):
+    """Encode le contenu en QR code et retourne une URL data (résultat mémorisé)"""
+    qr = qrcode.QRCode(
+        error_correction=qrcode.constants.ERROR_CORRECT_M,
+        box_size=10 if QR_CODE_FORMAT == 'svg' else PNG_BOX_SIZE,
+        border=1
+    )
+    qr.add_data(payload)
+    qr.make(fit=True)
+
+    output = io.BytesIO()
+    if QR_CODE_FORMAT == 'png':
+        qr.make_image(image_factory=PilImage).save(output, optimize=True)
+        mime_type = 'image/png'
+    else:
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(output)
+        mime_type = 'image/svg+xml'
+
+    encoded = base64.b64encode(output.getvalue()).decode('utf-8')
+    return f"data:{mime_type};base64,{encoded}"
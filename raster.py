@@ -0,0 +1,73 @@
+"""Sortie image (PNG/WebP) des billets, pour les portefeuilles mobiles et les aperçus.
+
+WeasyPrint ne produit plus que du PDF : le billet est mis en page comme
+d'habitude (mêmes template et CSS) puis la page du PDF est rastérisée avec
+pdfium à la résolution demandée et encodée avec Pillow.
+"""
+import io
+import os
+import threading
+
+import pypdfium2
+
+RASTER_FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+}
+RASTER_DEFAULT_DPI = int(os.environ.get('RASTER_DEFAULT_DPI', 150))
+RASTER_MAX_DPI = int(os.environ.get('RASTER_MAX_DPI', 600))
+RASTER_MIN_DPI = 36
+RASTER_WEBP_QUALITY = int(os.environ.get('RASTER_WEBP_QUALITY', 85))
+
+# Résolution de référence des PDF (points par pouce)
+PDF_DPI = 72
+
+# pdfium n'est pas thread-safe : ouverture, rendu et fermeture passent tous par ce verrou
+_pdfium_lock = threading.Lock()
+
+
+def parse_raster_options(output_format, dpi):
+    """Valide le format et la résolution demandés; retourne (format, dpi) ou (None, None) pour un PDF"""
+    output_format = (output_format or 'pdf').lower()
+    if output_format == 'pdf':
+        return None, None
+    if output_format not in RASTER_FORMATS:
+        raise ValueError(f"Format non supporté: {output_format} (pdf, png ou webp)")
+    try:
+        dpi = int(dpi) if dpi is not None else RASTER_DEFAULT_DPI
+    except (TypeError, ValueError):
+        raise ValueError("dpi doit être un entier")
+    if not RASTER_MIN_DPI <= dpi <= RASTER_MAX_DPI:
+        raise ValueError(f"dpi doit être compris entre {RASTER_MIN_DPI} et {RASTER_MAX_DPI}")
+    return output_format, dpi
+
+
+def mimetype(output_format):
+    return RASTER_FORMATS[output_format][1]
+
+
+def rasterise_pdf(pdf_file, output_format, dpi):
+    """Rastérise la première page d'un PDF (fichier binaire ou octets) et retourne l'image encodée"""
+    if hasattr(pdf_file, 'read'):
+        pdf_file.seek(0)
+        pdf_file = pdf_file.read()
+    with _pdfium_lock:
+        document = pypdfium2.PdfDocument(pdf_file)
+        try:
+            page = document[0]
+            bitmap = page.render(scale=dpi / PDF_DPI)
+            # Bitmap BGR : Pillow en fait une copie, indépendante de la mémoire de pdfium
+            image = bitmap.to_pil()
+            # Fermeture explicite, sous le verrou, plutôt que par le ramasse-miettes d'un autre thread
+            bitmap.close()
+            page.close()
+        finally:
+            document.close()
+
+    pillow_format = RASTER_FORMATS[output_format][0]
+    output = io.BytesIO()
+    if pillow_format == 'PNG':
+        image.save(output, format='PNG', optimize=True)
+    else:
+        image.save(output, format='WEBP', quality=RASTER_WEBP_QUALITY, method=4)
+    return output.getvalue()
@@ -0,0 +1,112 @@
+"""Moteur de rendu des billets.
+
+Les templates Jinja d'un design sont compilés une seule fois (à la création
+du moteur, donc à l'import) au lieu d'être recompilés à chaque requête par
+`render_template_string`, et ses feuilles de style sont analysées une seule
+fois par processus (voir `assets`). Par requête, il ne reste que le rendu
+des champs variables du billet puis la mise en page WeasyPrint; le PDF est
+écrit selon le profil de `pdf_output`.
+
+WeasyPrint n'est pas conçu pour le multi-thread (configuration de polices
+Pango et feuilles de style partagées par le processus) : l'analyse HTML, la
+mise en page et l'écriture du PDF sont sérialisées par un verrou de
+processus. Les threads gunicorn restent libres pour le reste (images,
+envoi des réponses, refus rapides).
+"""
+import functools
+import hashlib
+import threading
+
+import jinja2
+from weasyprint import HTML
+
+import assets
+import pdf_output
+from metrics import stage
+
+pdf_output.install_font_subset_cache()
+
+# Un seul rendu WeasyPrint à la fois par processus
+_render_lock = threading.Lock()
+
+
+class TicketRenderer:
+    """Pipeline de rendu d'un design de billet (CSS + templates précompilés)"""
+
+    def __init__(self, css, single_template, multiple_template, icons_url=None,
+                 design='default', design_version=None):
+        # Arguments de construction : permettent de recréer le moteur dans un autre processus
+        self.spec = (css, single_template, multiple_template, icons_url, design, design_version)
+        # Version du design (clés de cache) : change avec le manifeste, le CSS ou un template
+        self.version = hashlib.sha256(
+            '\0'.join(part or '' for part in self.spec).encode('utf-8')
+        ).hexdigest()[:12]
+        self.css = css
+        self.icons_url = icons_url
+        self.design = design
+        self.design_version = design_version
+        # Même comportement que Flask pour les templates en chaîne : échappement actif
+        self._jinja_env = jinja2.Environment(autoescape=True)
+        self.single_template = self._jinja_env.from_string(single_template)
+        self.multiple_template = self._jinja_env.from_string(multiple_template)
+
+    @property
+    def stylesheets(self):
+        """Feuilles de style pré-analysées du design"""
+        if self.icons_url:
+            return assets.get_stylesheets(self.css, self.icons_url)
+        return assets.get_stylesheets(self.css)
+
+    def warm_up(self):
+        """Analyse les feuilles de style et rapatrie les polices avant le premier rendu"""
+        if self.icons_url:
+            assets.warm_up(self.css, self.icons_url)
+        else:
+            assets.warm_up(self.css)
+
+    def render_single_html(self, ticket, **context):
+        with stage('render_html'):
+            return self.single_template.render(ticket=ticket, **context)
+
+    def render_multiple_html(self, tickets, **context):
+        with stage('render_html'):
+            return self.multiple_template.render(tickets=tickets, **context)
+
+    def write_pdf(self, html_content, target=None, base_url=None, shared_assets=None):
+        """Met en page le HTML et écrit le PDF dans `target` (ou retourne les octets)"""
+        url_fetcher = assets.cached_url_fetcher
+        if shared_assets:
+            url_fetcher = functools.partial(url_fetcher, shared_assets=shared_assets)
+        # Attente du verrou chronométrée à part : elle mesure la contention entre threads
+        with stage('render_wait'):
+            _render_lock.acquire()
+        try:
+            with stage('html_parse'):
+                html_doc = HTML(
+                    string=html_content,
+                    base_url=base_url,
+                    url_fetcher=url_fetcher
+                )
+            with stage('layout'):
+                document = html_doc.render(
+                    stylesheets=self.stylesheets,
+                    optimize_size=pdf_output.OPTIMIZE_SIZE,
+                    font_config=assets.FONT_CONFIG
+                )
+            with stage('write_pdf'):
+                return pdf_output.write_document(document, target)
+        finally:
+            _render_lock.release()
+
+    def render_ticket_pdf(self, ticket, target=None, base_url=None):
+        return self.write_pdf(self.render_single_html(ticket), target, base_url)
+
+    def render_tickets_pdf(self, tickets, target=None, base_url=None):
+        # L'image d'événement, identique sur tout le lot, n'est intégrée qu'une fois
+        tickets, shared_assets = assets.share_data_uris(tickets, 'event_image_url')
+        return self.write_pdf(self.render_multiple_html(tickets), target, base_url, shared_assets)
+
+    def iter_chunk_pdfs(self, tickets, chunk_size, base_url=None):
+        """Rend les billets par lots de taille fixe et produit un PDF par lot"""
+        for start in range(0, len(tickets), chunk_size):
+            yield self.render_tickets_pdf(tickets[start:start + chunk_size], base_url=base_url)
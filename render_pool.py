@@ -0,0 +1,114 @@
+"""Rendu parallèle des gros lots sur plusieurs processus.
+
+WeasyPrint est mono-thread et limité par le CPU : un lot volumineux est
+découpé en lots de taille fixe rendus par un pool de processus. Chaque
+processus est préchauffé (templates compilés, feuilles de style et polices
+chargées) à son démarrage, et les PDF des lots (ou des billets, en mode
+ZIP) sont restitués dans l'ordre des billets.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from render_engine import TicketRenderer
+
+logger = logging.getLogger(__name__)
+
+# Processus de rendu par worker gunicorn (0 désactive le rendu parallèle). Chaque worker a
+# son propre pool : par défaut, les cœurs sont partagés entre les WEB_CONCURRENCY workers
+_WORKERS = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+RENDER_PROCESSES = int(os.environ.get('RENDER_PROCESSES', max(1, (os.cpu_count() or 1) // max(1, _WORKERS))))
+PARALLEL_RENDER_MIN_TICKETS = int(os.environ.get('PARALLEL_RENDER_MIN_TICKETS', 100))
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+# Moteurs de rendu du processus fils, par design
+_renderers = {}
+
+
+def _get_renderer(spec):
+    renderer = _renderers.get(spec)
+    if renderer is None:
+        renderer = _renderers[spec] = TicketRenderer(*spec)
+        renderer.warm_up()
+    return renderer
+
+
+def _init_worker(spec):
+    """Préchauffe le processus fils avec le design par défaut"""
+    _get_renderer(spec)
+
+
+def _render_chunk(spec, tickets, base_url):
+    return _get_renderer(spec).render_tickets_pdf(tickets, base_url=base_url)
+
+
+def _render_ticket(spec, ticket, base_url):
+    return _get_renderer(spec).render_ticket_pdf(ticket, base_url=base_url)
+
+
+def _get_executor(renderer):
+    """Pool de rendu du worker courant, créé au premier gros lot"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            # spawn : les processus fils ne partagent pas l'état cairo/pango du parent
+            _executor = ProcessPoolExecutor(
+                max_workers=RENDER_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(renderer.spec,)
+            )
+            _executor_pid = os.getpid()
+            logger.info(f"Pool de rendu démarré: {RENDER_PROCESSES} processus")
+        return _executor
+
+
+def _ordered_results(executor, calls):
+    """Soumet les rendus et produit leurs résultats dans l'ordre.
+
+    Au plus deux rendus par processus sont en cours à la fois, ce qui borne
+    la mémoire occupée par les PDF en attente d'envoi.
+    """
+    in_flight = deque()
+    for function, *args in calls:
+        in_flight.append(executor.submit(function, *args))
+        if len(in_flight) >= RENDER_PROCESSES * 2:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def _use_pool(tickets):
+    return RENDER_PROCESSES > 1 and len(tickets) >= PARALLEL_RENDER_MIN_TICKETS
+
+
+def iter_chunk_pdfs(renderer, tickets, chunk_size, base_url=None):
+    """Produit les PDF des lots dans l'ordre des billets, en parallèle pour les gros lots"""
+    if not _use_pool(tickets):
+        yield from renderer.iter_chunk_pdfs(tickets, chunk_size, base_url=base_url)
+        return
+
+    executor = _get_executor(renderer)
+    yield from _ordered_results(executor, (
+        (_render_chunk, renderer.spec, tickets[start:start + chunk_size], base_url)
+        for start in range(0, len(tickets), chunk_size)
+    ))
+
+
+def iter_ticket_pdfs(renderer, tickets, base_url=None):
+    """Produit un PDF par billet (template unitaire), dans l'ordre des billets"""
+    if not _use_pool(tickets):
+        for ticket in tickets:
+            yield renderer.render_ticket_pdf(ticket, base_url=base_url)
+        return
+
+    executor = _get_executor(renderer)
+    yield from _ordered_results(executor, (
+        (_render_ticket, renderer.spec, ticket, base_url) for ticket in tickets
+    ))
@@ -0,0 +1,72 @@
+"""Cache des PDF rendus, indexé par le contenu normalisé des billets.
+
+La clé est une empreinte canonique des données validées du billet (hors
+champs volatils comme `generated_at`) et de la version du design : un même
+billet retéléchargé est servi depuis le disque au lieu d'être remis en page.
+La clé sert aussi d'ETag (`If-None-Match`).
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from cache import DiskCache
+
+RESULT_CACHE_DIR = os.environ.get(
+    'RESULT_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'results')
+)
+RESULT_CACHE_BYTES = int(os.environ.get('RESULT_CACHE_BYTES', 1024 * 1024 * 1024))
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', 24 * 3600))
+
+# Champs qui n'apparaissent pas dans le rendu ou changent à chaque requête
+VOLATILE_FIELDS = ('generated_at',)
+
+# Les entrées expirées sont aussi purgées (index et PDF) par le balayage du cache disque
+disk_cache = DiskCache(RESULT_CACHE_DIR, RESULT_CACHE_BYTES, max_age=RESULT_CACHE_TTL)
+
+_stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'coalesced': 0}
+_stats_lock = threading.Lock()
+
+
+def count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def result_cache_stats():
+    """Compteurs du cache de PDF (propres au worker courant)"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _canonical(ticket):
+    return {key: value for key, value in ticket.items() if key not in VOLATILE_FIELDS}
+
+
+def payload_key(tickets, version, kind='pdf'):
+    """Empreinte canonique d'un billet (ou d'une liste de billets) pour un design donné"""
+    if isinstance(tickets, dict):
+        tickets = [tickets]
+    canonical = json.dumps(
+        {'kind': kind, 'version': version, 'tickets': [_canonical(ticket) for ticket in tickets]},
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False,
+        default=str
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def open_cached(key):
+    """Ouvre le PDF en cache pour cette clé (fichier binaire), ou None"""
+    meta = disk_cache.get_meta(key)
+    if meta is None or time.time() - meta.get('stored_at', 0) > RESULT_CACHE_TTL:
+        return None
+    return disk_cache.open(meta['content_hash'])
+
+
+def store(key, data):
+    """Met en cache un PDF rendu (octets ou fichier binaire, copié par blocs)"""
+    disk_cache.set(key, data, {'stored_at': time.time()})
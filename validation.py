@@ -0,0 +1,171 @@
+"""Validation déclarative des billets.
+
+Le schéma d'un billet est décrit une seule fois (champs, obligations,
+limites de taille) puis compilé en une liste de contrôles. Un lot est
+entièrement vérifié avant tout téléchargement ou rendu, et toutes les
+erreurs sont renvoyées ensemble plutôt que la première seulement.
+"""
+import os
+
+MAX_TEXT_LENGTH = int(os.environ.get('MAX_TEXT_LENGTH', 300))
+MAX_URL_LENGTH = int(os.environ.get('MAX_URL_LENGTH', 2048))
+# Taille maximale d'une image fournie en data URI (la data URI entière, en octets)
+MAX_DATA_URI_BYTES = int(os.environ.get('MAX_DATA_URI_BYTES', 4 * 1024 * 1024))
+# Capacité d'un QR code au niveau de correction de qrcodes.py (version 40, correction M), en octets
+QR_PAYLOAD_CAPACITY = 2331
+# Taille maximale de `qr_payload`, en octets UTF-8 (bornée par la capacité du QR code)
+MAX_QR_PAYLOAD_LENGTH = min(int(os.environ.get('MAX_QR_PAYLOAD_LENGTH', 2048)), QR_PAYLOAD_CAPACITY)
+
+# Nombre maximal d'erreurs détaillées dans une réponse
+MAX_REPORTED_ERRORS = 100
+
+TEXT = (str, int, float)
+
+
+class ValidationError(ValueError):
+    """Erreurs de validation d'un billet ou d'un lot.
+
+    `errors` : liste de {'ticket': numéro (1..n) ou None, 'field': ..., 'error': ...}
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('; '.join(_format_error(error) for error in errors[:5]))
+
+
+def _format_error(error):
+    message = error['error']
+    if error.get('ticket') is not None:
+        message = f"Erreur billet {error['ticket']}: {message}"
+    return message
+
+
+class Field:
+    """Description d'un champ du billet"""
+
+    def __init__(self, types=TEXT, required=False, max_length=MAX_TEXT_LENGTH, max_bytes=None, image=False):
+        self.types = types
+        self.required = required
+        self.max_length = max_length
+        # Limite en octets UTF-8 plutôt qu'en caractères
+        self.max_bytes = max_bytes
+        # Image : URL http(s) ou data URI d'image, chacune avec sa propre limite de taille
+        self.image = image
+
+
+def _compile_field(name, field):
+    """Traduit un champ en fonction de contrôle : valeur -> message d'erreur ou None"""
+    type_names = ' ou '.join(dict.fromkeys(
+        {'str': 'texte', 'int': 'nombre', 'float': 'nombre'}[t.__name__] for t in field.types
+    ))
+
+    def check(value):
+        if value is None or value == '':
+            return f"Champ requis manquant: {name}" if field.required else None
+        # bool est une sous-classe de int : refusé explicitement
+        if not isinstance(value, field.types) or isinstance(value, bool):
+            return f"Type invalide pour {name}: {type_names} attendu"
+        if field.image:
+            if value.startswith('data:'):
+                if not value.startswith('data:image/'):
+                    return f"{name}: seules les images sont acceptées en data URI"
+                if len(value) > MAX_DATA_URI_BYTES:
+                    return f"{name}: image trop volumineuse ({len(value)} > {MAX_DATA_URI_BYTES} octets)"
+                return None
+            if not value.startswith(('http://', 'https://')):
+                return f"{name}: URL http(s) ou data URI d'image attendue"
+            if len(value) > MAX_URL_LENGTH:
+                return f"{name}: URL trop longue (maximum {MAX_URL_LENGTH} caractères)"
+            return None
+        if field.max_length and len(str(value)) > field.max_length:
+            return f"{name}: trop long (maximum {field.max_length} caractères)"
+        if field.max_bytes and len(str(value).encode('utf-8')) > field.max_bytes:
+            return f"{name}: trop long (maximum {field.max_bytes} octets en UTF-8)"
+        return None
+
+    return check
+
+
+class Schema:
+    """Schéma compilé : les contrôles sont construits une fois, à l'import"""
+
+    def __init__(self, fields, rules=()):
+        self.fields = fields
+        self._checks = tuple((name, _compile_field(name, field)) for name, field in fields.items())
+        # Règles portant sur plusieurs champs : billet -> (champ, message d'erreur) ou None
+        self._rules = tuple(rules)
+
+    def errors(self, data):
+        """Liste des (champ, message) invalides d'un billet"""
+        if not isinstance(data, dict):
+            return [(None, "Le billet doit être un objet")]
+        errors = []
+        for name, check in self._checks:
+            message = check(data.get(name))
+            if message:
+                errors.append((name, message))
+        for rule in self._rules:
+            error = rule(data)
+            if error:
+                errors.append(error)
+        return errors
+
+
+def _require_qr_code(ticket):
+    if not ticket.get('qr_payload') and not ticket.get('qr_code'):
+        return 'qr_code', "Champ requis manquant: qr_code (ou qr_payload)"
+    return None
+
+
+TICKET_SCHEMA = Schema({
+    'event_title': Field(required=True),
+    'event_date_time': Field(required=True),
+    'event_location': Field(required=True),
+    'ticket_type': Field(required=True),
+    'reference': Field(required=True),
+    'event_address': Field(),
+    'organizer_name': Field(),
+    'ticket_price': Field(),
+    'generated_at': Field(),
+    'qr_payload': Field(max_length=None, max_bytes=MAX_QR_PAYLOAD_LENGTH),
+    'qr_code': Field(types=(str,), image=True),
+    'event_image_url': Field(types=(str,), image=True),
+    'current_ticket': Field(types=(int,)),
+    'total_tickets': Field(types=(int,)),
+}, rules=(_require_qr_code,))
+
+
+def validate_ticket(ticket):
+    """Vérifie un billet; lève ValidationError avec toutes ses erreurs"""
+    errors = [
+        {'ticket': None, 'field': field, 'error': message}
+        for field, message in TICKET_SCHEMA.errors(ticket)
+    ]
+    if errors:
+        raise ValidationError(errors)
+
+
+def validate_batch(tickets):
+    """Vérifie tous les billets d'un lot avant tout traitement; lève ValidationError"""
+    errors = []
+    for index, ticket in enumerate(tickets):
+        for field, message in TICKET_SCHEMA.errors(ticket):
+            errors.append({'ticket': index + 1, 'field': field, 'error': message})
+        if len(errors) >= MAX_REPORTED_ERRORS:
+            break
+    if errors:
+        raise ValidationError(errors[:MAX_REPORTED_ERRORS])
+
+
+def merge_event_fields(data):
+    """Lot `{"event": {...}, "tickets": [...]}` : les champs communs de l'événement sont
+    fusionnés dans chaque billet (les champs du billet restent prioritaires)"""
+    event = data.get('event')
+    if event is None:
+        return data['tickets']
+    if not isinstance(event, dict):
+        raise ValidationError([{'ticket': None, 'field': 'event', 'error': "Le champ event doit être un objet"}])
+    return [
+        {**event, **ticket} if isinstance(ticket, dict) else ticket
+        for ticket in data['tickets']
+    ]
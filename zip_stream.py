@@ -0,0 +1,63 @@
+"""Archive ZIP produite en flux.
+
+Chaque fichier est ajouté à l'archive dès qu'il est prêt et les octets
+écrits sont aussitôt rendus à l'appelant : seule l'entrée en cours et le
+répertoire central (quelques dizaines d'octets par fichier) restent en
+mémoire. Les PDF étant déjà compressés, les entrées sont stockées sans
+recompression.
+
+Chaque en-tête local porte le CRC et les tailles de son entrée (pas de
+descripteur de données) : les lecteurs en flux, qui ne consultent pas le
+répertoire central, savent où s'arrête une entrée stockée.
+"""
+import io
+import zipfile
+
+
+class _EntryBuffer:
+    """Tampon de l'entrée en cours, positionnable dans l'archive entière.
+
+    `zipfile` revient sur l'en-tête local de l'entrée pour y écrire le CRC
+    et les tailles : seuls les octets pas encore rendus par `drain` restent
+    accessibles.
+    """
+
+    def __init__(self):
+        self._offset = 0
+        self._buffer = io.BytesIO()
+
+    def write(self, data):
+        return self._buffer.write(data)
+
+    def tell(self):
+        return self._offset + self._buffer.tell()
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self.tell()
+        elif whence == io.SEEK_END:
+            position += self._offset + len(self._buffer.getbuffer())
+        if position < self._offset:
+            raise OSError("Position déjà envoyée dans le flux ZIP")
+        self._buffer.seek(position - self._offset)
+        return position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = self._buffer.getvalue()
+        self._offset += len(data)
+        self._buffer = io.BytesIO()
+        return data
+
+
+def stream_zip(entries, compression=zipfile.ZIP_STORED):
+    """Produit une archive ZIP bloc par bloc à partir de paires (nom, contenu)"""
+    buffer = _EntryBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=compression) as archive:
+        for name, data in entries:
+            archive.writestr(name, data)
+            yield buffer.drain()
+    # Répertoire central, écrit à la fermeture de l'archive
+    yield buffer.drain()